@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Fingerprinted, precompressed static assets.
+
+`python manage.py build-assets` copies the images and the concatenated,
+minified stylesheet bundle from static/ into static/build/ under names
+containing a hash of their content, writes gzip (and, if the brotli
+module is installed, brotli) variants, and records the names in
+static/build/manifest.json.  Images are recompressed when Pillow is
+installed.
+
+The app serves built files from /assets/ with far-future immutable cache
+headers.  Templates call asset_urls(); when nothing has been built it
+falls back to the plain files under /static/.
+"""
+import os
+import re
+import gzip
+import json
+import hashlib
+import mimetypes
+from io import BytesIO
+from pyramid.response import FileResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(here, 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST = 'manifest.json'
+
+# stylesheet bundles, in the order base.jinja2 used to link them
+BUNDLES = {
+    'app.css': ['normalize.css', 'main.css', 'hilite.css'],
+}
+IMAGES = ['github.png', 'mail.png', 'phone.png', 'ys.jpg']
+# only text types are worth compressing
+COMPRESS_TYPES = ('.css', '.js', '.svg')
+# wider images are scaled down; the header photo is shown at most this wide
+MAX_IMAGE_WIDTH = 1600
+# one year; fingerprinted files never change
+MAX_AGE = 31536000
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def minify_css(css):
+    """Return css without comments and unneeded whitespace."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def fingerprint(name, data):
+    """Return name with a hash of data before its extension."""
+    base, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(base, hashlib.md5(data).hexdigest()[:12], ext)
+
+
+def optimize_image(name, data):
+    """Return recompressed image data, or data itself if that is smaller.
+
+    Images wider than MAX_IMAGE_WIDTH are scaled down first.
+    """
+    if Image is None:
+        return data
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    if width > MAX_IMAGE_WIDTH:
+        image = image.resize(
+            (MAX_IMAGE_WIDTH, height * MAX_IMAGE_WIDTH // width),
+            Image.ANTIALIAS)
+    out = BytesIO()
+    if name.endswith('.jpg'):
+        image.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    elif name.endswith('.png'):
+        image.save(out, 'PNG', optimize=True)
+    else:
+        return data
+    optimized = out.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+
+def gzip_bytes(data):
+    out = BytesIO()
+    # a fixed mtime keeps the output identical between builds
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def write_asset(build_dir, name, data, manifest):
+    """Write a fingerprinted asset and its compressed variants."""
+    built = fingerprint(name, data)
+    with open(os.path.join(build_dir, built), 'wb') as f:
+        f.write(data)
+    if name.endswith(COMPRESS_TYPES):
+        with open(os.path.join(build_dir, built + '.gz'), 'wb') as f:
+            f.write(gzip_bytes(data))
+        if brotli is not None:
+            with open(os.path.join(build_dir, built + '.br'), 'wb') as f:
+                f.write(brotli.compress(data))
+    manifest[name] = built
+    return built
+
+
+def build(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    """Build every asset into build_dir and return the manifest."""
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    manifest = {}
+    for name in IMAGES:
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = optimize_image(name, f.read())
+        write_asset(build_dir, name, data, manifest)
+
+    def rewrite(match):
+        # point stylesheet urls at the fingerprinted images
+        quote, url = match.groups()
+        return 'url({0}{1}{0})'.format(quote, manifest.get(url, url))
+
+    for bundle, sources in sorted(BUNDLES.items()):
+        parts = []
+        for source in sources:
+            with open(os.path.join(static_dir, source), 'rb') as f:
+                parts.append(f.read().decode('utf-8'))
+        css = minify_css(CSS_URL.sub(rewrite, u'\n'.join(parts)))
+        write_asset(build_dir, bundle, css.encode('utf-8'), manifest)
+
+    with open(os.path.join(build_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets(object):
+    """Maps logical asset names to urls, using the build manifest if any."""
+
+    def __init__(self, build_dir=BUILD_DIR, manifest=None):
+        self.build_dir = build_dir
+        self.manifest = manifest or {}
+        self.files = set(self.manifest.values())
+        # changes whenever a build changes any asset url
+        self.version = hashlib.md5(
+            json.dumps(self.manifest, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def load(cls, build_dir=BUILD_DIR):
+        """Return Assets for build_dir; unbuilt if it has no manifest."""
+        try:
+            with open(os.path.join(build_dir, MANIFEST)) as f:
+                manifest = json.load(f)
+        except IOError:
+            manifest = None
+        return cls(build_dir, manifest)
+
+    def urls(self, name):
+        """Return the urls to link for a logical asset name."""
+        if name in self.manifest:
+            return ['/assets/' + self.manifest[name]]
+        return ['/static/' + source for source in BUNDLES.get(name, [name])]
+
+    def url(self, name):
+        return self.urls(name)[0]
+
+    def response(self, request, built):
+        """Return a FileResponse for a built file, or None if unknown.
+
+        The brotli or gzip variant is sent when the client accepts it.
+        """
+        if built not in self.files:
+            return None
+        path = os.path.join(self.build_dir, built)
+        content_type = (mimetypes.guess_type(built)[0] or
+                        'application/octet-stream')
+        encoding = None
+        if request.headers.get('Accept-Encoding'):
+            for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+                if (candidate in request.accept_encoding and
+                        os.path.exists(path + suffix)):
+                    path, encoding = path + suffix, candidate
+                    break
+        response = FileResponse(path, request=request,
+                                content_type=content_type)
+        response.content_encoding = encoding
+        response.cache_control = 'public, max-age={}, immutable'.format(
+            MAX_AGE)
+        if built.endswith(COMPRESS_TYPES):
+            response.vary = ('Accept-Encoding',)
+        return response
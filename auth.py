@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Throttled, bounded password verification for the login view.
+
+bcrypt is slow on purpose, so checking passwords on waitress's request
+threads lets a burst of login attempts occupy every thread.  Instead
+do_login hands checks to a PasswordVerifier: a few worker threads behind a
+small queue.  When the queue is full the attempt is refused at once rather
+than waiting, so at most workers + queue_size request threads are ever
+tied up in logins.
+
+Before any hashing, per client address and per username RateLimiters
+refuse attempts that arrive faster than their token buckets refill.
+"""
+import os
+import math
+import time
+import Queue
+import threading
+from cryptacular.bcrypt import BCRYPTPasswordManager
+from repoze.lru import LRUCache
+
+
+class LoginThrottled(Exception):
+    """A login attempt was refused without checking the password."""
+
+    status = '429 Too Many Requests'
+
+    def __init__(self, message, retry_after=1):
+        super(LoginThrottled, self).__init__(message)
+        # whole seconds, for the Retry-After header
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class VerifierBusy(LoginThrottled):
+    """Every verifier worker is busy and the queue is full."""
+
+    status = '503 Service Unavailable'
+
+
+def parse_limit(value):
+    """Return (attempts, seconds) from a limit such as '20/60'."""
+    attempts, seconds = value.split('/')
+    return int(attempts), float(seconds)
+
+
+class RateLimiter(object):
+    """Token buckets per key, holding up to burst tokens refilled over period.
+
+    Only the max_keys most recently seen keys are remembered.
+    """
+
+    def __init__(self, burst, period, max_keys=10000, clock=time.time):
+        self.burst = burst
+        self.rate = burst / float(period)
+        self.rejected = 0
+        self._clock = clock
+        self._buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token for key; return 0, or the seconds until one is due."""
+        now = self._clock()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets.put(key, (tokens, now))
+                self.rejected += 1
+                return (1 - tokens) / self.rate
+            self._buckets.put(key, (tokens - 1, now))
+            return 0
+
+    def stats(self):
+        return {
+            'burst': self.burst,
+            'per_second': self.rate,
+            'keys': len(self._buckets.data),
+            'rejected': self.rejected,
+        }
+
+
+class _Job(object):
+
+    def __init__(self, hashed, password):
+        self.hashed = hashed
+        self.password = password
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = False
+        self.error = None
+
+
+class PasswordVerifier(object):
+    """Checks passwords on a bounded pool of worker threads.
+
+    Threads start on first use in each process, so a verifier created
+    before server.py forks works in every worker.
+    """
+
+    def __init__(self, workers=1, queue_size=2, timeout=10, check=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._check = check or BCRYPTPasswordManager().check
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.verified = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.in_progress = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.check_total = 0.0
+        self.check_max = 0.0
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.queue_size)
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        queue = self._queue
+        while True:
+            job = queue.get()
+            started = time.time()
+            with self._lock:
+                self.in_progress += 1
+            try:
+                job.result = self._check(job.hashed, job.password)
+            except Exception as e:
+                job.error = e
+            finished = time.time()
+            with self._lock:
+                self.in_progress -= 1
+                self.verified += 1
+                waited = started - job.queued
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                checked = finished - started
+                self.check_total += checked
+                self.check_max = max(self.check_max, checked)
+            job.done.set()
+
+    def check(self, hashed, password):
+        """Return True if password matches hashed.
+
+        Raises VerifierBusy if the queue is full or no worker got to the
+        check within timeout seconds.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        job = _Job(hashed, password)
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise VerifierBusy('Too many logins in progress, try again')
+        if not job.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise VerifierBusy('Login timed out, try again')
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def stats(self):
+        """Return a dict of queue depth and verification latency figures."""
+        with self._lock:
+            verified = self.verified or 1
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queue_depth': self._queue.qsize() if self._queue else 0,
+                'in_progress': self.in_progress,
+                'verified': self.verified,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': self.wait_total / verified * 1000,
+                'wait_max_ms': self.wait_max * 1000,
+                'check_avg_ms': self.check_total / verified * 1000,
+                'check_max_ms': self.check_max * 1000,
+            }
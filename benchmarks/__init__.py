@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the learning journal; run from the repository root."""
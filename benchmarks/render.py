@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Compare markdown render throughput before and after the renderer pool.
+
+"before" builds a new Markdown instance per call, with codehilite looking
+up Pygments lexers and formatters afresh, as journal.py used to; "after"
+uses renderer.render_markdown.
+
+Usage: python -m benchmarks.render [--seconds N]
+"""
+import argparse
+import time
+import contextlib
+import markdown
+from markdown.extensions import codehilite
+from renderer import MARKDOWN_EXTENSIONS, render_markdown
+
+# codehilite's own lookups, before render_markdown replaces them with the
+# cached ones; see renderer.patch_codehilite
+ORIGINAL_LOOKUPS = (codehilite.get_lexer_by_name,
+                    codehilite.get_formatter_by_name)
+
+PARAGRAPH = (
+    u"Today I worked through *decorators* and **closures**. A decorator "
+    u"wraps a function and returns a new callable; see [the docs]"
+    u"(https://docs.python.org/2/glossary.html#term-decorator).\n\n"
+)
+CODE_BLOCK = u"""```python
+def memoize(func):
+    cache = {}
+    def wrapper(*args):
+        if args not in cache:
+            cache[args] = func(*args)
+        return cache[args]
+    return wrapper
+```
+
+"""
+
+SAMPLES = [
+    ('small', u"# Day one\n\n" + PARAGRAPH),
+    ('medium', u"# A longer day\n\n" + PARAGRAPH * 20 + u"- one\n- two\n"),
+    ('code-heavy', u"# Snippets\n\n" + (PARAGRAPH + CODE_BLOCK) * 8),
+]
+
+
+def per_call(text):
+    return markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS)
+
+
+@contextlib.contextmanager
+def original_lookups():
+    """Run with codehilite's uncached Pygments lookups restored."""
+    patched = (codehilite.get_lexer_by_name,
+               codehilite.get_formatter_by_name)
+    (codehilite.get_lexer_by_name,
+     codehilite.get_formatter_by_name) = ORIGINAL_LOOKUPS
+    try:
+        yield
+    finally:
+        (codehilite.get_lexer_by_name,
+         codehilite.get_formatter_by_name) = patched
+
+
+def rate(func, text, seconds):
+    """Return how many times per second func(text) runs."""
+    func(text)
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < seconds:
+        func(text)
+        count += 1
+        elapsed = time.time() - start
+    return count / elapsed
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='time spent on each measurement')
+    args = parser.parse_args(argv)
+    print('{:<12} {:>12} {:>12} {:>8}'.format(
+        'sample', 'before/s', 'after/s', 'speedup'))
+    for name, text in SAMPLES:
+        # render_markdown patches codehilite on first use, so the
+        # baseline must put the originals back
+        with original_lookups():
+            before = rate(per_call, text, args.seconds)
+        after = rate(render_markdown, text, args.seconds)
+        print('{:<12} {:>12.1f} {:>12.1f} {:>7.2f}x'.format(
+            name, before, after, after / before))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""Measure latency, throughput, queries and bytes per request of the routes.
+
+For each table size, entries is emptied and seeded with generated
+markdown entries (paragraphs, lists and code blocks), then the WSGI app
+from journal.main() is driven in-process by a number of threads, asking
+for each of the given Accept-Encodings.  Each route reports p50/p95/p99
+latency and time to first byte, requests per second, database queries,
+bytes sent and CPU time of this process per request; results are
+printed and saved as json, and can be compared with an earlier run.
+
+THIS EMPTIES THE ENTRIES TABLE, so it needs its own database:
+
+    BENCH_DATABASE_URL=postgresql://... python -m benchmarks.routes \\
+        --sizes 1000,100000 --concurrency 1,4 --encodings identity,gzip,br \\
+        --output bench.json [--compare previous.json]
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import datetime
+import platform
+import threading
+import subprocess
+
+ROUTES = ('home', 'detail', 'new', 'edit', 'login')
+# also available: the Atom feed, and every entry as a streamed html page
+# and as a jsonl export
+EXTRA_ROUTES = ('feed', 'archive', 'export')
+
+PARAGRAPH = (
+    u"Worked through *{topic}* today. The tricky part was how {topic} "
+    u"interacts with **closures**; see [the docs](https://docs.python.org/2/)."
+    u"\n\n"
+)
+LIST = u"- read the chapter\n- write the tests\n- refactor\n\n"
+CODE = u"""```python
+def {name}(items):
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+```
+
+"""
+TOPICS = [u'decorators', u'generators', u'descriptors', u'metaclasses',
+          u'context managers', u'iterators', u'unicode', u'sqlalchemy']
+
+
+def sample_texts(count=40):
+    """Return count distinct entry texts of varying length and shape."""
+    rng = random.Random(7)
+    texts = []
+    for i in range(count):
+        topic = TOPICS[i % len(TOPICS)]
+        parts = [u'# Day {}\n\n'.format(i)]
+        for _ in range(rng.randint(1, 12)):
+            parts.append(PARAGRAPH.format(topic=topic))
+            if rng.random() < 0.3:
+                parts.append(LIST)
+            if rng.random() < 0.4:
+                parts.append(CODE.format(name=u'unique_{}'.format(i)))
+        texts.append(u''.join(parts))
+    return texts
+
+
+# text of the entries posted to new and edit
+POSTED_TEXT = sample_texts(1)[0]
+# the version of each entry edit last saw; edits send it and learn the next
+EDIT_VERSIONS = {}
+
+
+def seed(size):
+    """Replace every entry with size generated ones."""
+    import transaction
+    import bulk
+    from journal import DBSession
+    from renderer import render_markdown, RENDER_VERSION
+    from zope.sqlalchemy import mark_changed
+    texts = sample_texts()
+    # render each distinct text once rather than once per row
+    rendered = [render_markdown(text) for text in texts]
+    with transaction.manager:
+        DBSession.execute('TRUNCATE entries RESTART IDENTITY CASCADE')
+        mark_changed(DBSession())
+    start = datetime.datetime(2015, 1, 1)
+
+    def entries():
+        for i in range(size):
+            n = i % len(texts)
+            yield {
+                'title': u'Entry {} on {}'.format(i, TOPICS[n % len(TOPICS)]),
+                'text': texts[n],
+                'html': rendered[n],
+                'html_version': RENDER_VERSION,
+                'created': (start + datetime.timedelta(minutes=i)).isoformat(),
+            }
+
+    bulk.import_entries(entries())
+    EDIT_VERSIONS.clear()
+
+
+class QueryCounter(object):
+    """Counts statements executed by each thread."""
+
+    def __init__(self, engine):
+        import sqlalchemy as sa
+        self.local = threading.local()
+        sa.event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def take(self):
+        count = getattr(self.local, 'count', 0)
+        self.local.count = 0
+        return count
+
+
+def login_cookie(app):
+    """Return a Cookie header value for a logged in admin."""
+    from webob import Request
+    response = Request.blank('/login', POST={
+        'username': 'admin', 'password': 'secret'}).get_response(app)
+    assert response.status_int == 302, response.status
+    return '; '.join(value.split(';')[0] for value in
+                     response.headers.getall('Set-Cookie'))
+
+
+def make_request(route, size, cookie, rng):
+    """Return a webob Request for one call of a route."""
+    from webob import Request
+    if route == 'home':
+        return Request.blank('/')
+    if route == 'detail':
+        return Request.blank('/detail/{}'.format(rng.randint(1, size)))
+    if route == 'feed':
+        return Request.blank('/feed.atom')
+    if route == 'archive':
+        # only logged in users may list every entry
+        return Request.blank('/?all=1', headers={'Cookie': cookie})
+    if route == 'export':
+        return Request.blank('/api/entries?format=jsonl')
+    if route == 'login':
+        return Request.blank('/login', POST={
+            'username': 'admin', 'password': 'secret'})
+    if route == 'new':
+        request = Request.blank('/new', POST={
+            'title': u'Benchmark entry', 'text': POSTED_TEXT})
+    else:
+        id = rng.randint(1, size)
+        request = Request.blank('/edit', POST={
+            'id': str(id), 'version': str(EDIT_VERSIONS.get(id, 1)),
+            'title': u'Edited', 'text': POSTED_TEXT})
+    request.headers['Cookie'] = cookie
+    return request
+
+
+def decoder(encoding):
+    """Return a function decoding a response body's chunks in turn, as a
+    client would, to what they were before compression."""
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if encoding == 'br':
+        import brotli
+        return brotli.Decompressor().process
+    return lambda chunk: chunk
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile of already sorted values."""
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def drive(app, counter, route, size, cookie, requests, concurrency,
+          encoding='identity'):
+    """Send requests calls of route from concurrency threads."""
+    latencies = []
+    first_bytes = []
+    queries = []
+    sent = []
+    statuses = {}
+    lock = threading.Lock()
+    per_thread = [requests // concurrency + (i < requests % concurrency)
+                  for i in range(concurrency)]
+
+    def work(count, seed):
+        rng = random.Random(seed)
+        for _ in range(count):
+            request = make_request(route, size, cookie, rng)
+            if encoding != 'identity':
+                request.headers['Accept-Encoding'] = encoding
+            counter.take()
+            start = time.time()
+            response = request.get_response(app)
+            # streamed bodies are made as they are read
+            length, first_byte, body = 0, None, []
+            decode = decoder(response.content_encoding)
+            try:
+                for chunk in response.app_iter:
+                    # the first byte is the first the client can show, so a
+                    # compressed body's header alone does not count
+                    if first_byte is None and decode(chunk):
+                        first_byte = time.time() - start
+                    length += len(chunk)
+                    if route == 'edit':
+                        body.append(chunk)
+            finally:
+                if hasattr(response.app_iter, 'close'):
+                    response.app_iter.close()
+            elapsed = time.time() - start
+            if route == 'edit' and response.status_int in (200, 409):
+                # a 409 is a lost race with another thread; it carries the
+                # current version, so the entry's next edit succeeds
+                EDIT_VERSIONS[int(request.POST['id'])] = json.loads(
+                    decoder(response.content_encoding)(''.join(body)))[
+                        'version']
+            with lock:
+                latencies.append(elapsed)
+                first_bytes.append(first_byte or elapsed)
+                queries.append(counter.take())
+                sent.append(length)
+                statuses[response.status_int] = statuses.get(
+                    response.status_int, 0) + 1
+
+    threads = [threading.Thread(target=work, args=(count, i))
+               for i, count in enumerate(per_thread)]
+    start = time.time()
+    cpu = sum(os.times()[:2])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+    latencies.sort()
+    first_bytes.sort()
+    return {
+        'route': route,
+        'size': size,
+        'concurrency': concurrency,
+        'encoding': encoding,
+        'requests': requests,
+        'rps': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'ttfb_p50_ms': percentile(first_bytes, 0.50) * 1000,
+        'queries_per_request': sum(queries) / float(len(queries)),
+        'bytes_per_request': sum(sent) / float(len(sent)),
+        'cpu_ms_per_request': cpu / requests * 1000,
+        'statuses': dict((str(k), v) for k, v in statuses.items()),
+    }
+
+
+def make_app(database_url, concurrency, page_cache):
+    """Return the app from journal.main(), configured for benchmarking."""
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'WAITRESS_THREADS': str(concurrency),
+        # the benchmark logs in far faster than a person would
+        'LOGIN_ADDR_LIMIT': '1000000/1',
+        'LOGIN_USER_LIMIT': '1000000/1',
+        'LOGIN_QUEUE_SIZE': str(concurrency),
+        'JOURNAL_AUTO_MIGRATE': '1',
+    })
+    os.environ.pop('AUTH_PASSWORD', None)
+    os.environ.pop('AUTH_USERNAME', None)
+    if not page_cache:
+        os.environ['JOURNAL_PAGE_CACHE_SIZE'] = '0'
+    from journal import main
+    return main()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print each result's change from a matching earlier result."""
+    def key(result):
+        # runs from before encodings were measured sent no Accept-Encoding
+        return (result['size'], result['concurrency'],
+                result.get('encoding', 'identity'), result['route'])
+    earlier = dict((key(r), r) for r in previous['results'])
+    print('\nchange from {}'.format(previous.get('revision')))
+    for result in results:
+        old = earlier.get(key(result))
+        if old is None:
+            continue
+        line = ('{:>8} {:>4} {:<8} {:<8} rps {:+7.1%}  p95 {:+7.1%}  '
+                'queries {:+.1f}'.format(
+                    result['size'], result['concurrency'],
+                    result['encoding'], result['route'],
+                    result['rps'] / old['rps'] - 1,
+                    result['p95_ms'] / old['p95_ms'] - 1,
+                    result['queries_per_request'] -
+                    old['queries_per_request']))
+        if 'bytes_per_request' in old:
+            line += '  bytes {:+7.1%}'.format(
+                result['bytes_per_request'] / old['bytes_per_request'] - 1)
+        print(line)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCH_DATABASE_URL'),
+                        help='database to empty and seed '
+                             '(default: BENCH_DATABASE_URL)')
+    parser.add_argument('--sizes', default='1000',
+                        help='comma separated entry counts, e.g. 1000,100000')
+    parser.add_argument('--concurrency', default='1,4',
+                        help='comma separated thread counts')
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help='comma separated, from {}'.format(
+                            ', '.join(ROUTES + EXTRA_ROUTES)))
+    parser.add_argument('--encodings', default='identity,gzip',
+                        help='comma separated Accept-Encodings to send, '
+                             'e.g. identity,gzip,br')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route and concurrency')
+    parser.add_argument('--no-page-cache', action='store_true',
+                        help='disable the in-process page cache')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--compare', help='earlier results json file')
+    args = parser.parse_args(argv)
+    if not args.database_url:
+        parser.error('set --database-url or BENCH_DATABASE_URL')
+    sizes = [int(size) for size in args.sizes.split(',')]
+    levels = [int(level) for level in args.concurrency.split(',')]
+    routes = args.routes.split(',')
+    encodings = args.encodings.split(',')
+
+    app = make_app(args.database_url, max(levels), not args.no_page_cache)
+    from journal import DBSession
+    counter = QueryCounter(DBSession.bind)
+    cookie = login_cookie(app)
+    results = []
+    print('{:>8} {:>4} {:<8} {:<8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} '
+          '{:>7}'.format('size', 'conc', 'encoding', 'route', 'req/s',
+                         'p50 ms', 'p95 ms', 'p99 ms', 'ttfb ms', 'queries',
+                         'bytes', 'cpu ms'))
+    for size in sizes:
+        seed(size)
+        app.registry.page_cache.clear()
+        for level in levels:
+            for encoding in encodings:
+                for route in routes:
+                    result = drive(app, counter, route, size, cookie,
+                                   args.requests, level, encoding)
+                    results.append(result)
+                    print('{size:>8} {concurrency:>4} {encoding:<8} '
+                          '{route:<8} {rps:>9.1f} {p50_ms:>8.1f} '
+                          '{p95_ms:>8.1f} {p99_ms:>8.1f} '
+                          '{ttfb_p50_ms:>8.1f} {queries_per_request:>8.1f} '
+                          '{bytes_per_request:>9.0f} '
+                          '{cpu_ms_per_request:>7.2f}'.format(**result))
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'page_cache': not args.no_page_cache,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Report how long a fresh process takes to import and configure the app.
+
+Each run starts a new interpreter, times the imports of the heavy
+dependencies in turn (each is charged for what it pulls in first), then
+journal.main() by phase.  Medians over the runs are printed.
+
+Usage: python -m benchmarks.startup [--runs N] [--budget MS]
+
+With --budget, exits non-zero when the median main() time exceeds it.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+IMPORTS = [
+    'pyramid.config',
+    'sqlalchemy',
+    'zope.sqlalchemy',
+    'pyramid_tm',
+    'psycopg2',
+    'markdown',
+    'cryptacular.bcrypt',
+    'journal',
+]
+
+CHILD = """
+import json, sys, time
+timings = []
+for name in %r:
+    start = time.time()
+    __import__(name)
+    timings.append(('import ' + name, (time.time() - start) * 1000))
+import journal
+start = time.time()
+app = journal.main()
+total = (time.time() - start) * 1000
+timings.extend(('main: ' + k, v)
+               for k, v in app.registry.settings['journal.startup_ms'].items())
+timings.append(('main total', total))
+json.dump(timings, sys.stdout)
+""" % (IMPORTS,)
+
+
+def measure():
+    """Return [(phase, ms)] from one fresh interpreter."""
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=here)
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=None,
+                        help='fail if main() takes longer, in ms')
+    args = parser.parse_args(argv)
+    runs = [measure() for _ in range(args.runs)]
+    phases = [name for name, _ in runs[0]]
+    results = dict((name, median([dict(r)[name] for r in runs]))
+                   for name in phases)
+    imports = sum(ms for name, ms in results.items()
+                  if name.startswith('import '))
+    for name in phases:
+        print('{:<32} {:>8.1f} ms'.format(name, results[name]))
+    print('{:<32} {:>8.1f} ms'.format('imports total', imports))
+    if args.budget is not None and results['main total'] > args.budget:
+        print('main() took {:.1f} ms, over the {:.1f} ms budget'.format(
+            results['main total'], args.budget))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Bulk import and export of journal entries.
+
+Imports read entries from JSON Lines, CSV or a directory of markdown
+files a batch at a time.  Each batch is sent with COPY into a temporary
+staging table and moved into entries by one INSERT ... SELECT, which also
+fills in the search vector and defaults.  Markdown can be pre-rendered
+by a pool of processes; otherwise entries are rendered when first viewed
+or by `manage.py backfill-html`.
+
+Exports stream entries from a server-side cursor (JSON Lines), with
+COPY ... TO STDOUT (CSV), or one file per entry (markdown).
+
+Use through `python manage.py import` and `python manage.py export`.
+"""
+import os
+import io
+import csv
+import sys
+import json
+import datetime
+import logging
+import multiprocessing
+from itertools import islice
+import transaction
+from zope.sqlalchemy import mark_changed
+from journal import (
+    DBSession,
+    RENDER_VERSION,
+    search_document,
+    stream_entries,
+)
+from renderer import render_markdown
+
+log = logging.getLogger(__file__)
+
+# formats read and written; markdown means a directory of .md files
+FORMATS = ('jsonl', 'csv', 'markdown')
+# columns sent to the staging table, in COPY order
+STAGED_COLUMNS = ('title', 'text', 'created', 'html', 'html_version')
+# columns written by a CSV export
+EXPORT_COLUMNS = ('id', 'title', 'text', 'created', 'modified')
+
+CREATE_STAGING = """
+CREATE TEMPORARY TABLE IF NOT EXISTS entries_import (
+    title TEXT,
+    text TEXT,
+    created TIMESTAMP,
+    html TEXT,
+    html_version VARCHAR (40)
+) ON COMMIT DROP
+"""
+
+# imported rows count as written now, so page validators change
+MOVE_STAGED = """
+INSERT INTO entries
+    (title, text, created, modified, html, html_version, search_vector)
+SELECT title, coalesce(text, ''), coalesce(created, now() at time zone 'utc'),
+       now() at time zone 'utc', html, html_version,
+       """ + search_document('title', 'text') + """
+FROM entries_import
+"""
+
+
+def guess_format(path):
+    """Return the format for a path from its extension, or None.
+
+    Directories, and paths without an extension, hold markdown files.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path) or (path != '-' and not ext):
+        return 'markdown'
+    return {'.jsonl': 'jsonl', '.json': 'jsonl', '.csv': 'csv'}.get(ext)
+
+
+def read_jsonl(stream):
+    """Yield entry dicts from JSON Lines with title, text and created."""
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    """Yield entry dicts from CSV with a title,text[,created] header."""
+    for row in csv.DictReader(stream):
+        yield dict((key, value.decode('utf-8') if value else None)
+                   for key, value in row.items())
+
+
+def read_markdown(directory):
+    """Yield entry dicts from the .md files in a directory.
+
+    A first line of "# Title" is the title, otherwise the file name is;
+    the file's modification time is the created time.
+    """
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.md'):
+            continue
+        path = os.path.join(directory, name)
+        with io.open(path, encoding='utf-8') as f:
+            text = f.read()
+        title = os.path.splitext(name)[0]
+        first, _, rest = text.partition(u'\n')
+        if first.startswith(u'# '):
+            title, text = first[2:].strip(), rest.lstrip(u'\n')
+        created = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+        yield {'title': title, 'text': text, 'created': created.isoformat()}
+
+
+def render_entry(entry):
+    """Return entry with its html rendered; run in worker processes."""
+    entry['html'] = render_markdown(entry.get('text') or u'')
+    entry['html_version'] = RENDER_VERSION
+    return entry
+
+
+def batches(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def to_csv(entries):
+    """Return a COPY CSV file object for a batch of entry dicts."""
+    out = io.BytesIO()
+    writer = csv.writer(out)
+    for entry in entries:
+        row = []
+        for column in STAGED_COLUMNS:
+            value = entry.get(column)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        writer.writerow(row)
+    out.seek(0)
+    return out
+
+
+def import_entries(entries, batch_size=10000, render=False, jobs=None):
+    """Insert entries (dicts of title, text and created) in one transaction.
+
+    Only one batch is held in memory at a time.  With render, markdown is
+    rendered by jobs processes (default: one per core).  Returns the
+    number of entries imported.
+    """
+    pool = multiprocessing.Pool(jobs) if render else None
+    total = 0
+    try:
+        with transaction.manager:
+            session = DBSession()
+            cursor = session.connection().connection.cursor()
+            cursor.execute(CREATE_STAGING)
+            for batch in batches(entries, batch_size):
+                if pool is not None:
+                    batch = pool.map(render_entry, batch, chunksize=100)
+                cursor.copy_expert(
+                    'COPY entries_import ({}) FROM STDIN WITH CSV'.format(
+                        ', '.join(STAGED_COLUMNS)),
+                    to_csv(batch))
+                cursor.execute(MOVE_STAGED)
+                cursor.execute('TRUNCATE entries_import')
+                total += len(batch)
+                log.info('imported %d entries', total)
+            cursor.execute('ANALYZE entries')
+            mark_changed(session)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return total
+
+
+def import_path(path, format=None, **options):
+    """Import entries from a file, '-' for stdin, or markdown directory."""
+    format = format or guess_format(path)
+    if format == 'markdown':
+        return import_entries(read_markdown(path), **options)
+    reader = {'jsonl': read_jsonl, 'csv': read_csv}[format]
+    if path == '-':
+        return import_entries(reader(sys.stdin), **options)
+    with open(path, 'rb') as f:
+        return import_entries(reader(f), **options)
+
+
+def export_csv(out):
+    """Write every entry to out as CSV with a header, using COPY."""
+    with transaction.manager:
+        cursor = DBSession().connection().connection.cursor()
+        cursor.copy_expert(
+            'COPY (SELECT {0} FROM entries ORDER BY id) '
+            'TO STDOUT WITH CSV HEADER'.format(', '.join(EXPORT_COLUMNS)),
+            out)
+
+
+def export_jsonl(out):
+    """Write every entry to out as JSON Lines."""
+    for chunk in stream_entries(DBSession.bind, list(EXPORT_COLUMNS)):
+        out.write(chunk)
+
+
+def export_markdown(directory):
+    """Write each entry to <id>.md in directory."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for chunk in stream_entries(DBSession.bind, ['id', 'title', 'text']):
+        for entry in map(json.loads, chunk.splitlines()):
+            path = os.path.join(directory, '{}.md'.format(entry['id']))
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(u'# {}\n\n{}'.format(entry['title'], entry['text']))
+
+
+def export_path(path, format=None):
+    """Export every entry to a file, '-' for stdout, or markdown directory."""
+    format = format or guess_format(path) or 'jsonl'
+    if format == 'markdown':
+        return export_markdown(path)
+    export = {'jsonl': export_jsonl, 'csv': export_csv}[format]
+    if path == '-':
+        return export(sys.stdout)
+    with open(path, 'wb') as out:
+        return export(out)
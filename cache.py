@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""In-process cache of rendered pages for anonymous visitors.
+
+Anonymous requests for the home and detail pages get byte-identical html
+until an entry is added or edited, so the rendered responses are kept in
+size-capped, expiring LRU caches.  add2_entry and edit_entry invalidate the
+affected pages once their transaction commits.
+
+Those invalidations only reach the process that made the write.  Writes
+made by other processes, such as the prefork server's other workers, are
+noticed when a request finds check_interval seconds have passed since the
+last check: the newest entry modification time is read, as feeds.py
+does, and every page is dropped if it changed.  So a page is served at
+most check_interval seconds after another process changed it, plus any
+replica lag, rather than until it expires.
+"""
+import time
+import threading
+import transaction
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.response import Response
+from repoze.lru import ExpiringLRUCache
+from webob.datetime_utils import parse_date
+
+# response headers that are kept with a cached page
+CACHED_HEADERS = (
+    'Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary',
+)
+# headers that a 304 response repeats
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+
+def after_commit(func, *args):
+    """Call func(*args) once the current transaction commits successfully."""
+    def hook(success):
+        if success:
+            func(*args)
+    transaction.get().addAfterCommitHook(hook)
+
+
+class CachedPage(object):
+    """The body and headers of a rendered response.
+
+    encodings holds the body's compressed variants, made by the
+    compression tween the first time each is asked for.
+    """
+
+    def __init__(self, response):
+        self.body = response.body
+        self.encodings = {}
+        self.headers = [(name, response.headers[name])
+                        for name in CACHED_HEADERS if name in response.headers]
+        self.etag = response.headers.get('ETag', '').strip('"')
+        self.last_modified = response.last_modified
+
+    def is_current(self, request):
+        """Return True if the client's cached copy matches this page.
+
+        ETags are compared weakly, so a compressed copy matches too.
+        """
+        if request.headers.get('If-None-Match') is not None:
+            return bool(self.etag) and self.etag in request.if_none_match
+        since = parse_date(request.headers.get('If-Modified-Since'))
+        return (since is not None and self.last_modified is not None and
+                since >= self.last_modified)
+
+    def respond(self, request):
+        """Return a response for request, a 304 if its copy is current."""
+        if self.is_current(request):
+            return HTTPNotModified(headers=[
+                (name, value) for name, value in self.headers
+                if name in VALIDATOR_HEADERS])
+        response = Response(body=self.body, headerlist=list(self.headers))
+        response.encodings = self.encodings
+        return response
+
+
+class PageCache(object):
+    """Rendered anonymous pages for the home and detail routes.
+
+    Listing pages are keyed by host and page cursor, detail pages by entry
+    id and host.  Pages rendered while an invalidation happened are not
+    stored, so a page read before a commit cannot outlive it.
+
+    last_modified, if given, returns when any entry last changed; see
+    check().
+    """
+
+    def __init__(self, size=1000, timeout=300, last_modified=None,
+                 check_interval=2, clock=time.time):
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.checks = 0
+        self._last_modified = last_modified
+        self._clock = clock
+        # the first check drops whatever was cached before it
+        self._seen = None
+        self._next_check = clock() + check_interval
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._hosts = set()
+        if size > 0:
+            self.listing = ExpiringLRUCache(size, default_timeout=timeout)
+            self.entries = ExpiringLRUCache(size, default_timeout=timeout)
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def key(self, request):
+        """Return the cache key for request, or None if it is not cacheable."""
+        if not self.enabled or request.method != 'GET':
+            return None
+        if request.authenticated_userid:
+            return None
+        route = request.matched_route.name
+        if route == 'home':
+            if 'all' in request.params:
+                # the full listing is streamed, not held in memory
+                return None
+            return (route, request.host_url,
+                    request.params.get('before', None),
+                    request.params.get('after', None))
+        if route == 'detail':
+            return (route, request.host_url, int(request.matchdict['id']))
+        return None
+
+    def check(self):
+        """Drop every page if entries changed since the last check, which
+        catches writes made by other processes.
+
+        Does nothing until check_interval seconds have passed since the
+        last check, so it costs one indexed query per interval.
+        """
+        if not self.enabled or self._last_modified is None:
+            return
+        now = self._clock()
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            self.checks += 1
+        newest = self._last_modified()
+        if newest != self._seen:
+            self._seen = newest
+            self.clear()
+
+    def _cache_for(self, key):
+        return self.listing if key[0] == 'home' else self.entries
+
+    def get(self, key):
+        page = self._cache_for(key).get(key)
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return page
+
+    def generation(self):
+        return self._generation
+
+    def put(self, key, response, generation):
+        """Store response under key unless pages were invalidated meanwhile.
+
+        Returns the stored CachedPage, or None.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return None
+            self._hosts.add(key[1])
+            page = CachedPage(response)
+            self._cache_for(key).put(key, page)
+            return page
+
+    def invalidate_listing(self):
+        """Drop every cached listing page."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self.listing.clear()
+
+    def invalidate_entry(self, id):
+        """Drop the cached detail pages for an entry and every listing page."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            for host in self._hosts:
+                self.entries.invalidate(('detail', host, int(id)))
+            self.listing.clear()
+
+    def clear(self):
+        """Drop every cached page."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._generation += 1
+            self.listing.clear()
+            self.entries.clear()
+
+    def stats(self):
+        """Return a dict of cache usage figures."""
+        stats = {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'checks': self.checks,
+        }
+        if self.enabled:
+            stats['listing_pages'] = len(self.listing.data)
+            stats['detail_pages'] = len(self.entries.data)
+            stats['evictions'] = (self.listing.evictions +
+                                  self.entries.evictions)
+        return stats
+
+
+def cached_page(view):
+    """View decorator serving anonymous GETs from the registry's page cache.
+
+    Use as view_config(decorator=cached_page); it wraps the rendered view,
+    so the stored bytes are exactly what was sent.
+    """
+    def wrapper(context, request):
+        cache = request.registry.page_cache
+        key = cache.key(request)
+        if key is None:
+            return view(context, request)
+        cache.check()
+        page = cache.get(key)
+        if page is not None:
+            return page.respond(request)
+        generation = cache.generation()
+        response = view(context, request)
+        if response.status_int == 200:
+            page = cache.put(key, response, generation)
+            if page is not None:
+                response.encodings = page.encodings
+        return response
+    return wrapper
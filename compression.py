@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Compression of html, json and xml responses.
+
+A tween picks br or gzip from the request's Accept-Encoding and
+compresses 200 responses of a compressible type.  Buffered bodies smaller
+than min_size are sent as they are.  Streamed bodies, such as the jsonl
+export, are compressed chunk by chunk as the server sends them, so they
+are never held in memory whole.
+
+Responses that come from a cache carry an `encodings` dict, shared by
+every response made from the same cached bytes; the compressed variants
+are kept there, so each is made once per cached page rather than once per
+request.  CachedPage and feeds.Document provide one.
+
+A compressed response's ETag is made weak, as its bytes differ from the
+uncompressed ones; validators compare If-None-Match weakly, so clients
+revalidate whichever variant they hold.
+
+JOURNAL_COMPRESS=0 turns it off, e.g. behind a proxy that compresses, and
+JOURNAL_COMPRESS_MIN_SIZE sets min_size in bytes.
+"""
+import zlib
+import timing
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# types worth compressing; images and assets are compressed already
+COMPRESSIBLE = frozenset([
+    'text/html', 'text/plain', 'text/css', 'application/javascript',
+    'application/json', 'application/x-ndjson', 'application/xml',
+    'application/atom+xml',
+])
+# smaller bodies fit in a packet or two anyway
+MIN_SIZE = 1024
+# responses are compressed on every cache miss, so favour speed over size
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def encodings():
+    """Return the encodings available, most preferred first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(request, offered=None):
+    """Return the encoding to send request, or None for none."""
+    if not request.headers.get('Accept-Encoding'):
+        return None
+    return request.accept_encoding.best_match(offered or encodings())
+
+
+def compressor(encoding):
+    """Return the compress(data), flush() and finish() functions of a
+    compressor.
+
+    flush() returns what compress() has held back so far, in a form the
+    client can decode before the rest arrives.
+    """
+    if encoding == 'br':
+        encoder = brotli.Compressor(quality=BROTLI_QUALITY)
+        return encoder.process, encoder.flush, encoder.finish
+    # wbits above 16 makes zlib write a gzip header and trailer
+    encoder = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (encoder.compress, lambda: encoder.flush(zlib.Z_SYNC_FLUSH),
+            encoder.flush)
+
+
+def compress(body, encoding):
+    """Return body compressed with encoding."""
+    compress, _, finish = compressor(encoding)
+    return compress(body) + finish()
+
+
+class CompressedIter(object):
+    """An app_iter compressing another's chunks as they are read.
+
+    Each chunk is flushed, so the client can decode and show it as soon
+    as it arrives; streamed views already send chunks of a useful size.
+    close() closes the wrapped app_iter even if it was never read.
+    """
+
+    def __init__(self, app_iter, encoding):
+        self.app_iter = app_iter
+        self.encoding = encoding
+
+    def __iter__(self):
+        compress, flush, finish = compressor(self.encoding)
+        for chunk in self.app_iter:
+            data = compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def compressible(response):
+    """Return True if response's body may be sent compressed."""
+    return (response.content_type in COMPRESSIBLE and
+            not response.content_encoding and
+            'no-transform' not in (response.headers.get('Cache-Control') or
+                                   ''))
+
+
+def add_vary(response):
+    vary = tuple(response.vary or ())
+    if 'Accept-Encoding' not in vary:
+        response.vary = vary + ('Accept-Encoding',)
+
+
+def weaken_etag(response):
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = 'W/' + etag
+
+
+def compression_tween_factory(handler, registry):
+    """Tween compressing responses; see the module docstring."""
+    settings = registry.settings or {}
+    if not settings.get('journal.compress', True):
+        return handler
+    min_size = int(settings.get('journal.compress_min_size', MIN_SIZE))
+
+    def compression_tween(request):
+        response = handler(request)
+        if response.status_int == 304 and response.vary:
+            # a 304 has no type, but repeats the Vary of the page's 200
+            add_vary(response)
+            return response
+        if response.status_int != 200 or not compressible(response):
+            return response
+        add_vary(response)
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return response
+        app_iter = response.app_iter
+        if not isinstance(app_iter, (list, tuple)):
+            length = response.content_length
+            if length is not None and length < min_size:
+                return response
+            response.app_iter = CompressedIter(app_iter, encoding)
+            response.content_length = None
+        else:
+            if len(response.body) < min_size:
+                return response
+            cached = getattr(response, 'encodings', None)
+            body = cached.get(encoding) if cached is not None else None
+            if body is None:
+                with timing.measure('compress'):
+                    body = compress(response.body, encoding)
+                if cached is not None:
+                    cached[encoding] = body
+            response.body = body
+        response.content_encoding = encoding
+        weaken_etag(response)
+        return response
+    return compression_tween
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""The Atom feed and sitemap, kept up to date incrementally.
+
+Feed readers and crawlers poll often, so the documents are generated
+once and served with validators until entries change; the compression
+tween keeps their compressed variants alongside them.  Feeds
+holds the newest sitemap_size entries' ids and dates, the rendered html
+of the newest feed_size of them, and each entry's line of the sitemap.
+When they may have changed, only the entries modified since the last look
+are fetched and merged in, and only their sitemap lines are made again.
+
+Commits in this process call changed(), so the next request picks up
+their entries.  Changes made by other processes are noticed when a
+request finds check_interval seconds have passed since the last check,
+which costs one indexed max(modified) query.  Between checks serving a
+document runs no queries at all.
+"""
+import bisect
+import hashlib
+import datetime
+import threading
+from pyramid.renderers import render
+from pyramid.response import Response
+from webob.datetime_utils import UTC
+from markupsafe import escape
+
+FEED_TEMPLATE = 'templates/feed.jinja2'
+# the sitemap is put together from per-entry lines, so it is not a template
+SITEMAP_START = (
+    u'<?xml version="1.0" encoding="utf-8"?>\n'
+    u'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+SITEMAP_URL = u'  <url><loc>{}</loc><lastmod>{}</lastmod></url>\n'
+SITEMAP_HOME = u'  <url><loc>{}</loc></url>\n'
+SITEMAP_END = u'</urlset>\n'
+W3C_DATETIME = '%Y-%m-%dT%H:%M:%SZ'
+# a sitemap may list at most this many urls
+SITEMAP_SIZE = 50000
+# more changed entries than this are merged by sorting everything again
+MERGE_LIMIT = 100
+# entries modified this long before the newest one seen are fetched again,
+# in case their transactions committed after a later one
+SLACK = datetime.timedelta(seconds=60)
+
+
+class Document(object):
+    """A generated document, its compressed variants and its validators."""
+
+    def __init__(self, body, content_type, last_modified):
+        self.body = body
+        self.encodings = {}
+        self.content_type = content_type
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = last_modified
+
+    def response(self, request, max_age=0):
+        """Return a conditional response for the document.
+
+        webob answers a request whose copy is current with a 304.
+        """
+        response = Response(body=self.body, content_type=self.content_type,
+                            charset='utf-8', conditional_response=True)
+        response.encodings = self.encodings
+        response.etag = self.etag
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified.replace(tzinfo=UTC)
+        response.cache_control = 'public, max-age={}'.format(max_age)
+        return response
+
+
+class Feeds(object):
+    """The feed and sitemap documents of model, an Entry-like class.
+
+    model provides last_modified(), changed_since(since, limit) and
+    rendered(ids); see those methods of journal.Entry.
+    """
+
+    def __init__(self, model, feed_size=20, sitemap_size=SITEMAP_SIZE,
+                 check_interval=10, clock=None):
+        self.model = model
+        self.feed_size = feed_size
+        self.sitemap_size = sitemap_size
+        self.check_interval = check_interval
+        self._clock = clock or datetime.datetime.utcnow
+        self._lock = threading.Lock()
+        self._changed = True
+        self._checked = None
+        self._last_modified = None
+        self._entries = {}
+        self._content = {}
+        # held entries oldest first, and their (created, id) keys
+        self._ordered = []
+        self._keys = []
+        self._documents = {}
+        # {host: {id: sitemap line}}
+        self._sitemap_lines = {}
+        self.checks = 0
+        self.fetched = 0
+        self.generated = 0
+
+    def changed(self):
+        """Note that entries changed; call once their transaction commits."""
+        self._changed = True
+
+    def _refresh(self):
+        """Merge in entries changed since the last look, if it is due."""
+        now = self._clock()
+        forced = self._changed
+        if not forced and now - self._checked < datetime.timedelta(
+                seconds=self.check_interval):
+            return
+        self._changed = False
+        self._checked = now
+        self.checks += 1
+        newest = self.model.last_modified()
+        if newest == self._last_modified and not forced:
+            return
+        since = None
+        if self._last_modified is not None:
+            since = self._last_modified - SLACK
+        rows = self.model.changed_since(since, limit=self.sitemap_size)
+        if since is not None and len(rows) == self.sitemap_size:
+            # too many changes to tell which entries are newest; start over
+            self._entries, self._ordered, self._keys = {}, [], []
+            self._sitemap_lines = {}
+            rows = self.model.changed_since(None, limit=self.sitemap_size)
+        self._last_modified = newest
+        if not rows and since is not None:
+            return
+        self.fetched += len(rows)
+        changed = set(row.id for row in rows)
+        stale = changed | self._merge(rows)
+        for lines in self._sitemap_lines.values():
+            for id in stale:
+                lines.pop(id, None)
+        top = [row.id for row in self._newest(self.feed_size)]
+        content = dict((id, self._content[id]) for id in top
+                       if id in self._content and id not in changed)
+        missing = [id for id in top if id not in content]
+        if missing:
+            content.update(self.model.rendered(missing))
+        self._content = content
+        self._documents = {}
+
+    def _merge(self, rows):
+        """Put changed rows in order; return the ids of any dropped."""
+        keys, ordered = self._keys, self._ordered
+        if len(rows) > MERGE_LIMIT:
+            for row in rows:
+                self._entries[row.id] = row
+            ordered[:] = sorted(self._entries.values(),
+                                key=lambda row: (row.created, row.id))
+            keys[:] = [(row.created, row.id) for row in ordered]
+        else:
+            for row in rows:
+                old = self._entries.get(row.id)
+                if old is not None:
+                    i = bisect.bisect_left(keys, (old.created, old.id))
+                    del keys[i], ordered[i]
+                key = (row.created, row.id)
+                i = bisect.bisect_left(keys, key)
+                keys.insert(i, key)
+                ordered.insert(i, row)
+                self._entries[row.id] = row
+        excess = len(ordered) - self.sitemap_size
+        if excess <= 0:
+            return set()
+        dropped = set(row.id for row in ordered[:excess])
+        del keys[:excess], ordered[:excess]
+        for id in dropped:
+            del self._entries[id]
+        return dropped
+
+    def _newest(self, count=None):
+        """Return up to count held entries, newest first."""
+        ordered = self._ordered
+        if count is not None:
+            ordered = ordered[-count:] if count else []
+        return ordered[::-1]
+
+    def document(self, request, name):
+        """Return the named Document for request's host, current as of now."""
+        with self._lock:
+            self._refresh()
+            key = (name, request.host_url)
+            document = self._documents.get(key)
+            if document is None:
+                if name == 'feed':
+                    body, content_type = self._feed(request), (
+                        'application/atom+xml')
+                else:
+                    body, content_type = self._sitemap(request), (
+                        'application/xml')
+                document = self._documents[key] = Document(
+                    body.encode('utf-8'), content_type, self._last_modified)
+                self.generated += 1
+            return document
+
+    def _feed(self, request):
+        entries = [dict(row._asdict(), html=self._content[row.id])
+                   for row in self._newest(self.feed_size)]
+        return render(FEED_TEMPLATE, {
+            'entries': entries, 'updated': self._last_modified,
+        }, request=request)
+
+    def _sitemap(self, request):
+        lines = self._sitemap_lines.setdefault(request.host_url, {})
+        home = escape(request.route_url('home'))
+        if self._last_modified is None:
+            parts = [SITEMAP_START, SITEMAP_HOME.format(home)]
+        else:
+            parts = [SITEMAP_START, SITEMAP_URL.format(
+                home, self._last_modified.strftime(W3C_DATETIME))]
+        for row in reversed(self._ordered):
+            line = lines.get(row.id)
+            if line is None:
+                line = lines[row.id] = SITEMAP_URL.format(
+                    escape(request.route_url('detail', id=row.id)),
+                    row.modified.strftime(W3C_DATETIME))
+            parts.append(line)
+        parts.append(SITEMAP_END)
+        return u''.join(parts)
+
+    def stats(self):
+        """Return a dict of how often entries were checked and fetched."""
+        return {
+            'entries': len(self._entries),
+            'checks': self.checks,
+            'entries_fetched': self.fetched,
+            'documents_generated': self.generated,
+        }
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Background jobs run once the transaction that queued them commits.
+
+Write views call JobQueue.defer(name, *args) rather than doing follow-up
+work such as rendering markdown themselves, so they respond as soon as
+the row is committed.  When the transaction commits, the job is handed to
+worker threads that run it in a transaction of its own.  If the
+transaction aborts, the job is dropped.
+
+With persist on, defer also inserts the job into the jobs table within the
+write's transaction, and the job's row is deleted in the transaction that
+runs it.  Rows left by a crash, a restart or a failure are run by
+`python manage.py run-jobs`.
+
+Jobs are functions registered with @job.  They may run more than once or
+out of order, so they work from the database's current state rather than
+from arguments captured when they were queued.
+"""
+import os
+import json
+import time
+import Queue
+import logging
+import threading
+import transaction
+import sqlalchemy as sa
+from zope.sqlalchemy import mark_changed
+from cache import after_commit
+
+log = logging.getLogger(__file__)
+
+# registered job functions by name; see job()
+JOBS = {}
+
+jobs_table = sa.Table(
+    'jobs', sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('name', sa.Unicode(127), nullable=False),
+    sa.Column('args', sa.UnicodeText, nullable=False),
+    sa.Column('created', sa.DateTime, nullable=False),
+    sa.Column('attempts', sa.Integer, nullable=False, default=0),
+    sa.Column('error', sa.UnicodeText),
+)
+
+
+def job(func):
+    """Register func as a job under its name."""
+    JOBS[func.__name__] = func
+    return func
+
+
+class JobQueue(object):
+    """Runs deferred jobs on a few worker threads.
+
+    Threads start on first use in each process, like PasswordVerifier's.
+    With workers=0, jobs run on the committing thread right after the
+    commit, which is simpler to follow when debugging.
+    """
+
+    def __init__(self, session, workers=1, queue_size=10000, persist=False):
+        self.session = session
+        self.workers = workers
+        self.queue_size = queue_size
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def defer(self, name, *args):
+        """Run job name with args after the current transaction commits."""
+        if name not in JOBS:
+            raise KeyError('no job named {!r}'.format(name))
+        job_id = None
+        if self.persist:
+            session = self.session()
+            job_id = session.execute(jobs_table.insert().values(
+                name=name, args=json.dumps(args), attempts=0,
+                created=sa.func.now()).returning(jobs_table.c.id)).scalar()
+            mark_changed(session)
+        after_commit(self.put, name, args, job_id, time.time())
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.queue_size)
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def put(self, name, args, job_id=None, queued=None):
+        """Queue a job now; defer() calls this after the commit."""
+        queued = queued or time.time()
+        if not self.workers:
+            return self.run(name, args, job_id, queued)
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((name, args, job_id, queued))
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            log.warning('job queue full, dropped %s%r', name, tuple(args))
+
+    def _work(self):
+        queue = self._queue
+        while True:
+            name, args, job_id, queued = queue.get()
+            try:
+                self.run(name, args, job_id, queued)
+            finally:
+                queue.task_done()
+
+    def run(self, name, args, job_id=None, queued=None):
+        """Run one job in its own transaction; return True if it succeeded.
+
+        A persisted job's row is deleted by the same transaction, or, if
+        the job fails, has its attempts and error updated.
+        """
+        started = time.time()
+        with self._lock:
+            self.running += 1
+        error = None
+        try:
+            with transaction.manager:
+                JOBS[name](*args)
+                if job_id is not None:
+                    session = self.session()
+                    session.execute(jobs_table.delete().where(
+                        jobs_table.c.id == job_id))
+                    mark_changed(session)
+        except Exception as e:
+            log.exception('job %s%r failed', name, tuple(args))
+            error = e
+        finished = time.time()
+        with self._lock:
+            self.running -= 1
+            if error is None:
+                self.done += 1
+            else:
+                self.failed += 1
+            waited = started - (queued or started)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.run_total += finished - started
+            self.run_max = max(self.run_max, finished - started)
+        if error is not None and job_id is not None:
+            with transaction.manager:
+                session = self.session()
+                session.execute(jobs_table.update().where(
+                    jobs_table.c.id == job_id).values(
+                        attempts=jobs_table.c.attempts + 1,
+                        error=unicode(error)))
+                mark_changed(session)
+        return error is None
+
+    def run_pending(self, max_attempts=5):
+        """Run persisted jobs tried fewer than max_attempts times, oldest
+        first; return how many succeeded."""
+        with transaction.manager:
+            rows = self.session().execute(
+                sa.select([jobs_table.c.id, jobs_table.c.name,
+                           jobs_table.c.args])
+                .where(jobs_table.c.attempts < max_attempts)
+                .order_by(jobs_table.c.id)).fetchall()
+        succeeded = 0
+        for id, name, args in rows:
+            succeeded += self.run(name, json.loads(args), id)
+        return succeeded
+
+    def join(self, timeout=None):
+        """Wait until every queued job has run; return False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue is not None and self._queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        """Return a dict of queue depth and job latency figures."""
+        with self._lock:
+            finished = (self.done + self.failed) or 1
+            return {
+                'workers': self.workers,
+                'persist': self.persist,
+                'queue_size': self.queue_size,
+                'queue_depth': self._queue.qsize() if self._queue else 0,
+                'running': self.running,
+                'done': self.done,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'wait_avg_ms': self.wait_total / finished * 1000,
+                'wait_max_ms': self.wait_max * 1000,
+                'run_avg_ms': self.run_total / finished * 1000,
+                'run_max_ms': self.run_max * 1000,
+            }
@@ -4,28 +4,64 @@ import logging
 from pyramid.config import Configurator
 from pyramid.session import SignedCookieSessionFactory
 from pyramid.view import view_config
-from waitress import serve
 import psycopg2
 from contextlib import closing
-from pyramid.events import NewRequest, subscriber
+from pyramid.events import BeforeRender, NewRequest, subscriber
+from pyramid.interfaces import IRendererFactory
+from pyramid_jinja2 import IJinja2Environment
 import datetime
-from pyramid.httpexceptions import HTTPFound, HTTPInternalServerError, HTTPForbidden
+import hashlib
+import threading
+import time
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPFound,
+    HTTPInternalServerError,
+    HTTPForbidden,
+    HTTPNotFound,
+    HTTPNotModified,
+    )
 from pyramid.authentication import AuthTktAuthenticationPolicy
+from pyramid.response import Response
 from pyramid.authorization import ACLAuthorizationPolicy
 from cryptacular.bcrypt import BCRYPTPasswordManager
 from pyramid.security import remember, forget
-import markdown
+from pyramid.settings import asbool
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import (
+    defer,
+    deferred,
+    load_only,
     scoped_session,
     sessionmaker,
     )
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 import json
+from collections import OrderedDict
+from webob.datetime_utils import UTC, parse_date
+from markupsafe import Markup, escape
+from renderer import RENDER_VERSION, render_markdown
+from cache import PageCache, after_commit, cached_page
+from assets import Assets, BUILD_DIR
+from auth import LoginThrottled, PasswordVerifier, RateLimiter, parse_limit
+from timing import TimedRendererFactory, instrument_engine
+from replicas import ReplicaSet, RoutingSession, current_replica
+from jobs import JobQueue, job
+from feeds import Feeds
+from revisions import (
+    apply_delta, make_delta, needs_snapshot, pack_text, unpack_text)
 
 here = os.path.dirname(os.path.abspath(__file__))
 
+DEFAULT_DATABASE_URL = 'postgresql://mark:@localhost:5432/learning-journal'
+# bcrypt hash of the development password "secret", so main() need not
+# hash it on every start; make real ones with `manage.py hash-password`
+DEFAULT_PASSWORD_HASH = (
+    '$2a$10$icY/1cIae.epJT5P0sGyJu.VxTZupyu/LqTl.ZaRzSmFf5O4HaG5K')
+
 # MATTLEE = "dbname=test-learning-journal user=postgres password=admin"
 
 # ON_MATTS = "C:\\Users\\jefimenko\\code_fellows\\dev_accel\\another-journal\\learning-journal\\journal.py"
@@ -50,9 +86,64 @@ here = os.path.dirname(os.path.abspath(__file__))
 # """
 
 # replaces def close, open, and connect db
-DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+# anonymous reads may go to a replica; see replicas.py
+DBSession = scoped_session(sessionmaker(
+    class_=RoutingSession, extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
+# number of entries shown per page of the home listing
+PAGE_SIZE = 20
+LIST_TEMPLATE = 'templates/list.jinja2'
+# listing cursors are "<created as digits>.<id>", e.g. 20150301093000123456.42
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(entry):
+    """Return the listing cursor pointing at the given entry."""
+    return u'{}.{}'.format(entry.created.strftime(CURSOR_FORMAT), entry.id)
+
+
+def decode_cursor(cursor):
+    """Return the (created, id) pair for a listing cursor, or None.
+
+    Raises ValueError if the cursor is malformed.
+    """
+    if not cursor:
+        return None
+    created, _, id = cursor.partition('.')
+    return datetime.datetime.strptime(created, CURSOR_FORMAT), int(id)
+
+
+# text search configuration for the search_vector column and queries
+SEARCH_CONFIG = 'english'
+# number of results per page of a search
+SEARCH_PAGE_SIZE = 10
+# ts_headline marks matches with these; they are turned into <mark> tags
+# after the snippet is escaped
+SNIPPET_START, SNIPPET_STOP = u'\x02', u'\x03'
+SNIPPET_OPTIONS = (
+    'StartSel=\x02, StopSel=\x03, MaxFragments=2, MaxWords=25, MinWords=10'
+)
+
+
+def search_document(title, text):
+    """Return SQL for the tsvector indexing title (weighted A) and text (B).
+
+    title and text are SQL expressions, such as column names or
+    :title and :text bind parameters.
+    """
+    return (
+        "setweight(to_tsvector('{config}', coalesce({title}, '')), 'A') || "
+        "setweight(to_tsvector('{config}', coalesce({text}, '')), 'B')"
+    ).format(config=SEARCH_CONFIG, title=title, text=text)
+
+
+def highlight(snippet):
+    """Return a search snippet as markup, with matches in <mark> tags."""
+    snippet = unicode(escape(snippet or u''))
+    return Markup(snippet.replace(SNIPPET_START, u'<mark>').replace(
+        SNIPPET_STOP, u'</mark>'))
+
 
 class Entry(Base):
     __tablename__ = 'entries'
@@ -62,25 +153,177 @@ class Entry(Base):
     created = sa.Column(
         sa.DateTime, nullable=False, default=datetime.datetime.utcnow
     )
+    # last time the entry was written; drives http caching
+    modified = sa.Column(
+        sa.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        server_default=sa.text("(now() at time zone 'utc')"), index=True
+    )
+    # counts edits; an edit must name the version it replaces, see
+    # from_request_edit.  It is also the number of the latest revision.
+    version = sa.Column(
+        sa.Integer, nullable=False, default=1, server_default=sa.text('1'))
+    # text rendered by render_markdown, and the RENDER_VERSION it was made with
+    html = sa.Column(sa.UnicodeText)
+    html_version = sa.Column(sa.Unicode(40))
+    # title and text for full text search, kept by from_request and
+    # from_request_edit
+    search_vector = deferred(sa.Column(TSVECTOR))
 
     def __repr__(self):
         return u"{}: {}".format(self.__class__.__name__, self.title)
 
+    def display_html(self):
+        """Return the rendered text, rendering it if the stored copy is stale.
+
+        The row is left as it is, as reads may come from a replica.  The
+        update_entry job and backfill-html store html, each only if the
+        entry is unmodified since they read its text.
+        """
+        if self.html is None or self.html_version != RENDER_VERSION:
+            return render_markdown(self.text)
+        return self.html
+
     @classmethod
     def all(cls):
         return DBSession.query(cls).order_by(cls.created.desc()).all()
 
+    @classmethod
+    def listing_query(cls, before=None, after=None, limit=PAGE_SIZE):
+        """Return the query behind listing(), fetching limit + 1 rows.
+
+        Only id, title and created are loaded, in (created, id) order so
+        the ix_entries_listing index covers the query.
+        """
+        key = sa.tuple_(cls.created, cls.id)
+        query = DBSession.query(cls).options(load_only('id', 'title', 'created'))
+        if after is not None:
+            query = query.filter(key > sa.tuple_(*after))
+            query = query.order_by(cls.created.asc(), cls.id.asc())
+        else:
+            if before is not None:
+                query = query.filter(key < sa.tuple_(*before))
+            query = query.order_by(cls.created.desc(), cls.id.desc())
+        # one extra row tells us whether there is another page
+        return query.limit(limit + 1)
+
+    @classmethod
+    def listing(cls, before=None, after=None, limit=PAGE_SIZE):
+        """Return one page of entries for the listing, most recent first.
+
+        before/after are decoded (created, id) cursors; the page holds the
+        entries just older than `before` or just newer than `after`.
+        Returns a tuple of (entries, has_newer, has_older).
+        """
+        entries = cls.listing_query(before, after, limit).all()
+        more = len(entries) > limit
+        entries = entries[:limit]
+        if after is not None:
+            entries.reverse()
+            return entries, more, True
+        return entries, before is not None, more
+
+    @classmethod
+    def archive_query(cls):
+        """Return a select of every entry's id, title and created, in
+        listing order."""
+        table = cls.__table__
+        return sa.select([table.c.id, table.c.title, table.c.created]).order_by(
+            table.c.created.desc(), table.c.id.desc())
+
+    @classmethod
+    def search(cls, terms, page=1, limit=SEARCH_PAGE_SIZE):
+        """Return one page of entries matching terms, best matches first.
+
+        Returns a tuple of (results, has_more); each result has id, title,
+        created, rank and a highlighted snippet of the text.  Snippets are
+        only made for the rows on the page.
+        """
+        query = sa.func.plainto_tsquery(SEARCH_CONFIG, terms)
+        rank = sa.func.ts_rank_cd(cls.search_vector, query)
+        matches = DBSession.query(cls.id, rank.label('rank')).filter(
+            cls.search_vector.op('@@')(query)).order_by(
+            rank.desc(), cls.id.desc()).offset(
+            (page - 1) * limit).limit(limit + 1).subquery()
+        snippet = sa.func.ts_headline(
+            SEARCH_CONFIG, cls.text, query, SNIPPET_OPTIONS)
+        rows = DBSession.query(
+            cls.id, cls.title, cls.created, matches.c.rank,
+            snippet.label('snippet')).join(
+            matches, cls.id == matches.c.id).order_by(
+            matches.c.rank.desc(), cls.id.desc()).all()
+        return rows[:limit], len(rows) > limit
+
+    @classmethod
+    def last_modified(cls, id=None):
+        """Return when any entry, or the entry with the given id, last changed.
+
+        Returns None if there are no entries or no entry with that id.
+        """
+        if id is None:
+            return DBSession.query(sa.func.max(cls.modified)).scalar()
+        return DBSession.query(cls.modified).filter(cls.id == id).scalar()
+
+    @classmethod
+    def changed_since(cls, since=None, limit=None):
+        """Return the id, title, created and modified of entries.
+
+        With since, these are the entries modified after it, most recently
+        modified first; otherwise they are all entries, newest first.
+        """
+        query = DBSession.query(cls.id, cls.title, cls.created, cls.modified)
+        if since is None:
+            query = query.order_by(cls.created.desc(), cls.id.desc())
+        else:
+            # ix_entries_modified finds the few recent changes
+            query = query.filter(cls.modified > since).order_by(
+                cls.modified.desc())
+        return query.limit(limit).all()
+
+    @classmethod
+    def rendered(cls, ids):
+        """Return {id: html} for entries, rendering any stale html."""
+        rows = DBSession.query(
+            cls.id, cls.html, cls.html_version, cls.text).filter(
+            cls.id.in_(ids))
+        return dict((row.id, row.html if row.html_version == RENDER_VERSION
+                     else render_markdown(row.text)) for row in rows)
+
     @classmethod
     def by_id(cls, id):
         return DBSession.query(cls).filter(cls.id==id).one()
 
+    @classmethod
+    def detail(cls, id, with_text=False):
+        """Return an entry for display.
+
+        Unless with_text, text is only loaded if accessed; the edit form
+        shown to logged in users needs it.
+        """
+        query = DBSession.query(cls)
+        if not with_text:
+            query = query.options(defer('text'))
+        return query.filter(cls.id==id).one()
+
     @classmethod
     def from_request(cls, request):
-        title = request.params.get('title', None)
-        text = request.params.get('text', None)
-        created = datetime.datetime.utcnow()
-        new_entry = cls(title=title, text=text, created=created)
-        DBSession.add(new_entry)
+        """Insert a new entry and its first revision; return a dict of its
+        values.
+
+        One statement inserts both and returns the generated id and
+        created, so no second query is needed.  It stores the
+        search_vector too; html is left for the update_entry job, packing
+        the revision for the pack_revisions job.
+        """
+        values = {
+            'title': request.params.get('title', None),
+            'text': request.params.get('text', None),
+            'now': datetime.datetime.utcnow(),
+        }
+        values['id'], values['created'] = DBSession.execute(
+            INSERT_ENTRY, values).first()
+        # raw statements do not tell the transaction the session changed
+        mark_changed(DBSession())
+        return values
 
     @classmethod
     def most_recent(cls):
@@ -88,14 +331,246 @@ class Entry(Base):
 
     @classmethod
     def from_request_edit(cls, request):
-        title = request.params.get('title', None)
-        text = request.params.get('text', None)
-        id = request.params.get('id', None)
-        DBSession.query(cls).filter(cls.id == id).update({"title": title, "text": text})
+        """Update an entry from the request; return its new version.
+
+        The request names the version it edits, and the update only
+        happens if that is still the entry's version, so of two edits of
+        the same version one wins and the other returns None rather than
+        overwriting it.  Raises ValueError if no version is given.
+
+        The same statement stores the new search_vector and records the
+        new version as a revision, and the version it replaces too if the
+        entry has none yet.  Its html is cleared, so it is rendered when
+        shown until the update_entry job stores it.
+        """
+        version = int(request.params.get('version', ''))
+        row = DBSession.execute(EDIT_ENTRY, {
+            'id': request.params.get('id', None),
+            'version': version,
+            'title': request.params.get('title', None),
+            'text': request.params.get('text', None),
+            'now': datetime.datetime.utcnow(),
+        }).first()
+        mark_changed(DBSession())
+        return row[0] if row is not None else None
+
+    @classmethod
+    def current_version(cls, id):
+        """Return an entry's version, or None if there is no such entry."""
+        return DBSession.query(cls.version).filter(cls.id == id).scalar()
+
+
+@job
+def update_entry(id):
+    """Store an entry's rendered html.
+
+    It is rendered from the entry as it is now; if it changes meanwhile,
+    the update is skipped and left to the job queued by that change.
+    """
+    row = DBSession.query(Entry.text, Entry.modified).filter(
+        Entry.id == id).first()
+    if row is None:
+        return
+    DBSession.query(Entry).filter(
+        Entry.id == id, Entry.modified == row.modified).update({
+            'html': render_markdown(row.text),
+            'html_version': RENDER_VERSION,
+        }, synchronize_session=False)
+
+
+sa.Index('ix_entries_search', Entry.search_vector, postgresql_using='gin')
+# covers the listing: keyset paging on (created, id) without touching rows
+sa.Index(
+    'ix_entries_listing', Entry.created.desc(), Entry.id.desc(), Entry.title
+)
+
+# an entry, indexed for search, and its first revision
+INSERT_ENTRY = sa.text("""
+WITH entry AS (
+    INSERT INTO entries (title, text, created, modified, search_vector)
+    VALUES (:title, :text, :now, :now,
+        """ + search_document(':title', ':text') + """)
+    RETURNING id, created
+)
+INSERT INTO entry_revisions (entry_id, number, created, title, text)
+SELECT id, 1, created, :title, :text FROM entry
+RETURNING entry_id, created
+""")
+# an edit of the given version and its revision, returning the new
+# version; nothing happens if the entry is at another version.  Entries
+# from before revisions were kept get the version they are at recorded
+# first.  A concurrent edit holds the row until it commits, after which
+# the version no longer matches, so no lock is taken beforehand.
+EDIT_ENTRY = sa.text("""
+WITH old AS (
+    SELECT id, title, text, modified, version FROM entries
+    WHERE id = :id AND version = :version
+), edited AS (
+    UPDATE entries SET title = :title, text = :text, html = NULL,
+        html_version = NULL, modified = :now, version = version + 1,
+        search_vector = """ + search_document(':title', ':text') + """
+    WHERE id = :id AND version = :version
+    RETURNING id, version
+), first AS (
+    INSERT INTO entry_revisions (entry_id, number, created, title, text)
+    SELECT old.id, old.version, old.modified, old.title, old.text
+    FROM old JOIN edited ON edited.id = old.id
+    WHERE NOT EXISTS (
+        SELECT 1 FROM entry_revisions
+        WHERE entry_id = old.id AND number = old.version)
+)
+INSERT INTO entry_revisions (entry_id, number, created, title, text)
+SELECT id, version, :now, :title, :text FROM edited
+RETURNING number
+""")
+
+
+class EntryRevision(Base):
+    """A version of an entry's title and text; see revisions.py."""
+    __tablename__ = 'entry_revisions'
+    entry_id = sa.Column(
+        sa.Integer, sa.ForeignKey('entries.id', ondelete='CASCADE'),
+        primary_key=True)
+    number = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    created = sa.Column(sa.DateTime, nullable=False)
+    title = sa.Column(sa.Unicode(127), nullable=False)
+    # the text as written, until pack_revisions replaces it with data
+    text = sa.Column(sa.UnicodeText)
+    # a snapshot if base is number, otherwise a delta from the previous
+    # revision; base is the snapshot this one is rebuilt from, and
+    # chain_size the bytes of the deltas since it, this one's included
+    data = sa.Column(sa.LargeBinary)
+    base = sa.Column(sa.Integer)
+    chain_size = sa.Column(sa.Integer)
+
+    @classmethod
+    def history(cls, entry_id):
+        """Return an entry's revisions' number, created and title, oldest
+        first."""
+        return DBSession.query(cls.number, cls.created, cls.title).filter(
+            cls.entry_id == entry_id).order_by(cls.number).all()
+
+    @classmethod
+    def get(cls, entry_id, number):
+        """Return a revision of an entry as a dict, or None.
+
+        Besides number, created, title and text it has the base and
+        chain_size the next revision is packed against.  One query reads
+        the revision and the rows back to its snapshot.
+        """
+        base = DBSession.query(sa.func.coalesce(cls.base, cls.number)).filter(
+            cls.entry_id == entry_id, cls.number == number).as_scalar()
+        rows = DBSession.query(
+            cls.number, cls.created, cls.title, cls.text, cls.data, cls.base,
+            cls.chain_size).filter(
+            cls.entry_id == entry_id, cls.number <= number,
+            cls.number >= base).order_by(cls.number).all()
+        if not rows:
+            return None
+        text = None
+        for row in rows:
+            if row.text is not None:
+                text = row.text
+            elif row.base == row.number:
+                text = unpack_text(row.data)
+            else:
+                text = apply_delta(text, row.data)
+        row = rows[-1]
+        return {'number': row.number, 'created': row.created,
+                'title': row.title, 'text': text, 'base': row.base,
+                'chain_size': row.chain_size}
+
+
+@job
+def pack_revisions(entry_id):
+    """Store an entry's newly written revisions as snapshots or deltas.
+
+    The revisions are locked, so packing jobs for one entry take turns.
+    """
+    pending = DBSession.query(EntryRevision).filter(
+        EntryRevision.entry_id == entry_id, EntryRevision.data.is_(None)
+    ).order_by(EntryRevision.number).with_for_update().all()
+    previous = None
+    if pending and pending[0].number > 1:
+        previous = EntryRevision.get(entry_id, pending[0].number - 1)
+    for revision in pending:
+        data = snapshot = pack_text(revision.text)
+        base, chain_size = revision.number, 0
+        if previous is not None:
+            delta = make_delta(previous['text'], revision.text)
+            if not needs_snapshot(previous['number'] - previous['base'],
+                                  previous['chain_size'], delta, snapshot):
+                data, base = delta, previous['base']
+                chain_size = previous['chain_size'] + len(delta)
+        previous = {'number': revision.number, 'text': revision.text,
+                    'base': base, 'chain_size': chain_size}
+        revision.data, revision.base = data, base
+        revision.chain_size, revision.text = chain_size, None
+
 
 logging.basicConfig()
 log = logging.getLogger(__file__)
 
+
+def templates_version():
+    """Return a hash of the templates and render configuration.
+
+    It is part of every page ETag, so deploying new templates or
+    changing how markdown is rendered invalidates cached pages.
+    """
+    digest = hashlib.sha1(RENDER_VERSION.encode('utf-8'))
+    templates = os.path.join(here, 'templates')
+    for name in sorted(os.listdir(templates)):
+        with open(os.path.join(templates, name), 'rb') as template:
+            digest.update(template.read())
+    return digest.hexdigest()
+
+PAGE_VERSION = templates_version()
+
+
+def page_etag(request, *parts):
+    """Return an ETag for a page built from parts and the viewing user."""
+    settings = request.registry.settings or {}
+    version = settings.get('journal.page_version', PAGE_VERSION)
+    key = [version, request.authenticated_userid or '']
+    key.extend(parts)
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+def not_modified(request, etag, last_modified):
+    """Set caching headers for a page; check the client's cached copy.
+
+    Anonymous pages may be stored by shared caches for
+    journal.cache_max_age seconds; pages for logged in users are private.
+    Returns an HTTPNotModified response if the client's copy is current,
+    otherwise None and the view should render as usual.
+    """
+    response = request.response
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=UTC)
+    if request.authenticated_userid:
+        response.cache_control = 'private, no-cache'
+    else:
+        settings = request.registry.settings or {}
+        max_age = settings.get('journal.cache_max_age', 0)
+        response.cache_control = 'public, max-age=0, s-maxage={}'.format(
+            max_age)
+    response.vary = ('Cookie',)
+
+    if request.headers.get('If-None-Match') is not None:
+        # weakly, as the compression tween makes compressed ETags weak
+        current = etag in request.if_none_match
+    else:
+        since = parse_date(request.headers.get('If-Modified-Since'))
+        current = (since is not None and last_modified is not None and
+                   since >= response.last_modified)
+    if current:
+        headers = [(name, response.headers[name])
+                   for name in ('ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+                   if name in response.headers]
+        return HTTPNotModified(headers=headers)
+
 # @view_config(route_name='home', renderer='string')
 # def home(request):
 #     return "Hello World"
@@ -177,35 +652,69 @@ def add2_entry(request):
         if request.method == 'POST':
             try:
                 # write_entry(request)
-                Entry.from_request(request)
+                entry = Entry.from_request(request)
             except psycopg2.Error:
                 # this will catch any errors generated by the database
                 return HTTPInternalServerError
+            request.registry.jobs.defer('update_entry', entry['id'])
+            request.registry.jobs.defer('pack_revisions', entry['id'])
+            after_commit(request.registry.page_cache.invalidate_listing)
+            after_commit(request.registry.feeds.changed)
             # return HTTPFound(request.route_url('home'))
-            # cursor = request.db.cursor()
-            # cursor.execute(SELECT_MOST_RECENT)
-            # keys = ('id', 'title', 'text', 'created')
-            # temp = dict(zip(keys, cursor.fetchone()))
-            temp = Entry.most_recent()
-            # import pdb; pdb.set_trace()
-            temp.created = temp.created.strftime('%b %d, %Y')
-            del temp.__dict__['_sa_instance_state']
-            return temp.__dict__
+            return {
+                'id': entry['id'],
+                'title': entry['title'],
+                'text': entry['text'],
+                'created': entry['created'].strftime('%b %d, %Y'),
+            }
     else:
         return HTTPForbidden()
 
 
-@view_config(route_name='home', renderer='templates/list.jinja2')
+@view_config(route_name='home', renderer=LIST_TEMPLATE,
+             decorator=cached_page)
 def read_entries(request):
-    """Return a dictionary with entries and their data.
+    """Return a dictionary with one page of entries and their data.
     Returns by creation date, most recent first.
+    ?before=<cursor> and ?after=<cursor> page through older and newer entries.
+    ?all=1 lists every entry, streamed as it is rendered; see render_stream.
+    It reads and renders the whole table and is never cached, so only
+    logged in users may ask for it.
     """
     # cursor = request.db.cursor()
     # cursor.execute(SELECT_ENTRIES)
     # keys = ('id', 'title', 'text', 'created')
     # entries = [dict(zip(keys, row)) for row in cursor.fetchall()]
-    entries = Entry.all()
-    return {'entries': entries}
+    try:
+        before = decode_cursor(request.params.get('before', None))
+        after = decode_cursor(request.params.get('after', None))
+    except ValueError:
+        return HTTPBadRequest()
+    everything = asbool(request.params.get('all', False))
+    if everything and not request.authenticated_userid:
+        return HTTPForbidden()
+    last_modified = Entry.last_modified()
+    etag = page_etag(request, 'home', last_modified, before, after,
+                     everything)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+    if everything:
+        rows = StreamedRows(read_engine(), Entry.archive_query(),
+                            first_batch=PAGE_SIZE)
+        response = request.response
+        response.content_type = 'text/html'
+        response.app_iter = render_stream(
+            request, LIST_TEMPLATE,
+            {'entries': rows, 'newer': None, 'older': None}, rows)
+        return response
+    entries, has_newer, has_older = Entry.listing(before=before, after=after)
+    newer = older = None
+    if entries and has_newer:
+        newer = encode_cursor(entries[0])
+    if entries and has_older:
+        older = encode_cursor(entries[-1])
+    return {'entries': entries, 'newer': newer, 'older': older}
 
 
 def do_login(request):
@@ -214,11 +723,298 @@ def do_login(request):
     if not (username and password):
         raise ValueError('both username and password are required')
 
-    settings = request.registry.settings
-    manager = BCRYPTPasswordManager()
+    registry = request.registry
+    settings = registry.settings
+    throttle_login(request, username)
     if username == settings.get('auth.username', ''):
         hashed = settings.get('auth.password', '')
-        return manager.check(hashed, password)
+        verifier = getattr(registry, 'password_verifier', None)
+        if verifier is None:
+            return BCRYPTPasswordManager().check(hashed, password)
+        return verifier.check(hashed, password)
+
+
+def client_addr(request):
+    """Return the client's address, as seen by a trusted proxy if any."""
+    settings = request.registry.settings or {}
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded and settings.get('journal.trust_forwarded'):
+        # the proxy appends the address it saw; earlier ones can be forged
+        return forwarded.split(',')[-1].strip()
+    return request.remote_addr
+
+
+def throttle_login(request, username):
+    """Raise LoginThrottled if the client or username is trying too often."""
+    registry = request.registry
+    addr_limiter = getattr(registry, 'login_addr_limiter', None)
+    user_limiter = getattr(registry, 'login_user_limiter', None)
+    wait = 0
+    if addr_limiter is not None:
+        wait = addr_limiter.take(client_addr(request))
+    if not wait and user_limiter is not None:
+        wait = user_limiter.take(username.lower())
+    if wait:
+        raise LoginThrottled('Too many login attempts, try again later',
+                             retry_after=wait)
+
+
+@view_config(route_name='search', renderer='templates/search.jinja2')
+def search_entries(request):
+    """Return a page of entries matching the q parameter."""
+    terms = request.params.get('q', u'').strip()
+    try:
+        page = int(request.params.get('page', 1))
+    except ValueError:
+        return HTTPBadRequest('invalid page')
+    if page < 1:
+        return HTTPBadRequest('invalid page')
+    results, has_more = [], False
+    if terms:
+        results, has_more = Entry.search(terms, page)
+    return {
+        'q': terms,
+        'results': [{
+            'id': row.id,
+            'title': row.title,
+            'created': row.created,
+            'snippet': highlight(row.snippet),
+        } for row in results],
+        'previous': page - 1 if page > 1 else None,
+        'next': page + 1 if has_more else None,
+    }
+
+
+# fields the JSON API can return; collections default to the first four
+API_FIELDS = ('id', 'title', 'created', 'modified', 'text', 'html',
+              'version')
+API_LIST_FIELDS = API_FIELDS[:4]
+# largest page of a paged collection request
+API_MAX_LIMIT = 100
+# rows fetched at a time while streaming JSON Lines or a page
+STREAM_BATCH_SIZE = 1000
+# characters of a streamed page gathered before they are sent
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def api_fields(request, default):
+    """Return the fields named by the fields parameter, or default.
+
+    Raises ValueError for unknown fields.
+    """
+    value = request.params.get('fields', '')
+    if not value:
+        return list(default)
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = sorted(set(fields) - set(API_FIELDS))
+    if unknown or not fields:
+        raise ValueError('unknown fields: {}'.format(', '.join(unknown)))
+    return fields
+
+
+def api_limit(request):
+    """Return the page size asked for by the limit parameter.
+
+    Raises ValueError unless it is a positive number; larger ones than
+    API_MAX_LIMIT are capped.
+    """
+    limit = int(request.params.get('limit', PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    return min(limit, API_MAX_LIMIT)
+
+
+def api_columns(fields, *extra):
+    """Return the entries columns needed to serialize fields."""
+    names = list(fields) + list(extra)
+    if 'html' in fields:
+        # stale stored html is re-rendered from the text
+        names += ['text', 'html_version']
+    table = Entry.__table__
+    seen = set()
+    return [table.c[name] for name in names
+            if not (name in seen or seen.add(name))]
+
+
+def api_row(row, fields):
+    """Return a dict of the requested fields of a selected row."""
+    data = {}
+    for name in fields:
+        value = row[name]
+        if name == 'html' and row['html_version'] != RENDER_VERSION:
+            value = render_markdown(row['text'])
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        data[name] = value
+    return data
+
+
+class StreamedRows(object):
+    """The rows of a query, read from a server-side cursor as they are used.
+
+    It has its own connection, since it is read after the request's
+    transaction has ended, and keeps at most one batch of rows in memory.
+    The first batch is first_batch rows, so the first rows come quickly.
+    fetches counts the batches read so far.
+    """
+
+    def __init__(self, engine, query, first_batch=None):
+        self.engine = engine
+        self.query = query
+        self.first_batch = first_batch or STREAM_BATCH_SIZE
+        self.fetches = 0
+
+    def batches(self):
+        """Yield lists of rows until the query's rows run out."""
+        connection = self.engine.connect().execution_options(
+            stream_results=True)
+        try:
+            result = connection.execute(self.query)
+            size = self.first_batch
+            while True:
+                rows = result.fetchmany(size)
+                self.fetches += 1
+                if not rows:
+                    break
+                yield rows
+                size = STREAM_BATCH_SIZE
+        finally:
+            connection.close()
+
+    def __iter__(self):
+        for rows in self.batches():
+            for row in rows:
+                yield row
+
+
+def read_engine():
+    """Return the engine reads of this request use, such as a replica.
+
+    Streamed bodies are read after the tweens have returned, so they
+    must use the engine chosen while the view ran.
+    """
+    return current_replica() or DBSession.bind
+
+
+def stream_entries(engine, fields):
+    """Yield every entry as JSON Lines, reading from a server-side cursor."""
+    query = sa.select(api_columns(fields)).order_by(Entry.id)
+    for rows in StreamedRows(engine, query).batches():
+        yield ''.join(json.dumps(api_row(row, fields)) + '\n'
+                      for row in rows)
+
+
+def render_stream(request, renderer_name, value, rows=None):
+    """Return an app_iter rendering a jinja2 template as it is read.
+
+    The template gets the values a renderer would give it.  Its output is
+    sent about every STREAM_CHUNK_SIZE characters, and whenever rows, a
+    StreamedRows it reads, has fetched a batch, so what was rendered
+    before waiting on the database is not held back.
+    """
+    registry = request.registry
+    # subscribers add their values to the event itself
+    system = BeforeRender({
+        'request': request, 'req': request, 'context': request.context,
+        'renderer_name': renderer_name, 'view': None}, value)
+    registry.notify(system)
+    system = dict(system, **value)
+    template = registry.queryUtility(
+        IJinja2Environment, name='.jinja2').get_template(renderer_name)
+
+    def chunks():
+        pending, size, fetches = [], 0, 0
+        for piece in template.generate(system):
+            pending.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE or (
+                    rows is not None and rows.fetches != fetches):
+                fetches = rows.fetches if rows is not None else 0
+                yield u''.join(pending).encode('utf-8')
+                pending, size = [], 0
+        if pending:
+            yield u''.join(pending).encode('utf-8')
+    return chunks()
+
+
+@view_config(route_name='api_entries', renderer='json')
+def api_entries(request):
+    """Return entries as json, a page at a time, or all as JSON Lines.
+
+    Pages are newest first; pass the returned next cursor as before to get
+    the following page.  format=jsonl streams every entry in id order.
+    """
+    try:
+        fields = api_fields(request, API_LIST_FIELDS)
+        limit = api_limit(request)
+        before = decode_cursor(request.params.get('before', None))
+    except ValueError as e:
+        return HTTPBadRequest(str(e))
+    if request.params.get('format') == 'jsonl':
+        return Response(
+            app_iter=stream_entries(read_engine(), fields),
+            content_type='application/x-ndjson', charset=None)
+    table = Entry.__table__
+    query = sa.select(api_columns(fields, 'id', 'created'))
+    if before is not None:
+        query = query.where(
+            sa.tuple_(table.c.created, table.c.id) < sa.tuple_(*before))
+    query = query.order_by(
+        table.c.created.desc(), table.c.id.desc()).limit(limit + 1)
+    rows = DBSession.execute(query).fetchall()
+    next = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next = encode_cursor(rows[-1])
+    return {'entries': [api_row(row, fields) for row in rows], 'next': next}
+
+
+@view_config(route_name='api_entry', renderer='json')
+def api_entry(request):
+    """Return one entry as json."""
+    try:
+        fields = api_fields(request, API_FIELDS)
+    except ValueError as e:
+        return HTTPBadRequest(str(e))
+    query = sa.select(api_columns(fields)).where(
+        Entry.__table__.c.id == int(request.matchdict['id']))
+    row = DBSession.execute(query).first()
+    if row is None:
+        return HTTPNotFound()
+    return api_row(row, fields)
+
+
+@view_config(route_name='api_revisions', renderer='json')
+def api_revisions(request):
+    """Return the number, created and title of an entry's revisions.
+
+    Earlier versions are only shown to logged in users.
+    """
+    if not request.authenticated_userid:
+        return HTTPForbidden()
+    rows = EntryRevision.history(int(request.matchdict['id']))
+    return {'revisions': [{
+        'number': row.number,
+        'created': row.created.isoformat(),
+        'title': row.title,
+    } for row in rows]}
+
+
+@view_config(route_name='api_revision', renderer='json')
+def api_revision(request):
+    """Return one revision of an entry with its text."""
+    if not request.authenticated_userid:
+        return HTTPForbidden()
+    revision = EntryRevision.get(int(request.matchdict['id']),
+                                 int(request.matchdict['number']))
+    if revision is None:
+        return HTTPNotFound()
+    return {
+        'number': revision['number'],
+        'created': revision['created'].isoformat(),
+        'title': revision['title'],
+        'text': revision['text'],
+    }
 
 
 @view_config(route_name='login', renderer='templates/login.jinja2')
@@ -233,6 +1029,10 @@ def login(request):
             authenticated = do_login(request)
         except ValueError as e:
             error = str(e)
+        except LoginThrottled as e:
+            error = str(e)
+            request.response.status = e.status
+            request.response.headers['Retry-After'] = str(e.retry_after)
         if authenticated:
             headers = remember(request, username)
             return HTTPFound(request.route_url('home'), headers=headers)
@@ -251,31 +1051,280 @@ SELECT id, title, text, created FROM entries WHERE id=%s
 """
 
 
-@view_config(route_name='detail', renderer='templates/detail.jinja2')
+@view_config(route_name='detail', renderer='templates/detail.jinja2',
+             decorator=cached_page)
 def entry_details(request):
-    entry = Entry.by_id(request.matchdict.get('id', -1))
-    del entry.__dict__['_sa_instance_state']
-    entry.display_text = markdown.markdown(entry.text, extensions=['codehilite(linenums=True)', 'fenced_code'])
+    id = request.matchdict.get('id', -1)
+    last_modified = Entry.last_modified(id)
+    if last_modified is None:
+        return HTTPNotFound()
+    etag = page_etag(request, 'detail', id, last_modified)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+    entry = Entry.detail(id, with_text=bool(request.authenticated_userid))
+    entry.display_text = entry.display_html()
     return {'entry': entry, }
 
 
+@view_config(route_name='feed')
+def feed(request):
+    """Serve an Atom feed of the newest entries; see feeds.py."""
+    return request.registry.feeds.document(request, 'feed').response(
+        request, request.registry.settings.get('journal.cache_max_age', 0))
+
+
+@view_config(route_name='sitemap')
+def sitemap(request):
+    """Serve a sitemap of the home page and entries; see feeds.py."""
+    return request.registry.feeds.document(request, 'sitemap').response(
+        request, request.registry.settings.get('journal.cache_max_age', 0))
+
+
 # ported to ORM, but does not update database
 @view_config(route_name='edit', renderer='json')
 def edit_entry(request):
+    """Update an entry; return its title, version and where to get its html.
+
+    The html is rendered after the response by the update_entry job, but
+    html_url serves it, rendered if need be, straight away.  An edit of a
+    version that is no longer current gets a 409 with the current version.
+    """
     if request.authenticated_userid:
+        id = request.params.get('id', None)
+        result = {
+            'title': request.params.get('title', None),
+            'html_url': request.route_url(
+                'api_entry', id=id, _query={'fields': 'html'}),
+        }
         if request.method == 'POST':
             try:
-                Entry.from_request_edit(request)
+                version = Entry.from_request_edit(request)
+            except ValueError:
+                return HTTPBadRequest('the version being edited is required')
             except psycopg2.Error:
                 return HTTPInternalServerError
-            text = markdown.markdown(request.params.get('text', None), extensions=['codehilite(linenums=True)', 'fenced_code'])
-        return {'title': request.params.get('title', None), 'text': text}
+            if version is None:
+                current = Entry.current_version(id)
+                if current is None:
+                    return HTTPNotFound()
+                request.response.status = 409
+                return {'error': 'the entry was edited elsewhere',
+                        'version': current}
+            request.registry.jobs.defer('update_entry', id)
+            request.registry.jobs.defer('pack_revisions', id)
+            after_commit(request.registry.page_cache.invalidate_entry, id)
+            after_commit(request.registry.feeds.changed)
+            result['version'] = version
+        return result
     else:
         return HTTPForbidden()
 
 
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kw):
+        QueuePool.__init__(self, *args, **kw)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except sa.exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def stats(self):
+        """Return a dict of pool usage figures; times are in milliseconds."""
+        with self._stats_lock:
+            checkouts = self.checkouts
+            return {
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': self.overflow(),
+                'max_overflow': self._max_overflow,
+                'checkouts': checkouts,
+                'timeouts': self.timeouts,
+                'wait_total_ms': self.wait_total * 1000,
+                'wait_avg_ms': self.wait_total * 1000 / (checkouts or 1),
+                'wait_max_ms': self.wait_max * 1000,
+            }
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Check a pooled connection is alive before handing it out.
+
+    Raising DisconnectionError makes the pool discard the connection and
+    try a fresh one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise sa.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def make_engine(settings):
+    """Return a database engine for the sqlalchemy.* settings.
+
+    The engine uses a MeteredQueuePool. Connections are pinged on checkout
+    unless db.pool_pre_ping is false.
+    """
+    engine = sa.engine_from_config(
+        settings, 'sqlalchemy.', poolclass=MeteredQueuePool
+    )
+    if asbool(settings.get('db.pool_pre_ping', True)):
+        sa.event.listen(engine.pool, 'checkout', ping_connection)
+    return engine
+
+
+def internal_request(request):
+    """Return True if request may see internal endpoints.
+
+    Those are open to logged in users and to requests from this machine.
+    """
+    return bool(request.authenticated_userid) or (
+        request.remote_addr in ('127.0.0.1', '::1'))
+
+
+@subscriber(BeforeRender)
+def add_asset_urls(event):
+    """Make asset_urls(name) available to templates."""
+    event['asset_urls'] = event['request'].registry.assets.urls
+
+
+@subscriber(BeforeRender)
+def add_detail_url(event):
+    """Make detail_url(id), an entry's detail page url, available to templates.
+
+    route_url keeps every id it quotes in a process-wide cache, which
+    would grow with the journal as every entry is listed, so the url is
+    made from a prefix found on first use.
+    """
+    request = event['request']
+    prefix = []
+
+    def detail_url(id):
+        if not prefix:
+            url = request.route_url('detail', id=0)
+            prefix.append(url[:url.rindex('/') + 1])
+        return prefix[0] + str(int(id))
+    event['detail_url'] = detail_url
+
+
+@view_config(route_name='assets')
+def serve_asset(request):
+    """Serve a fingerprinted asset built by `manage.py build-assets`."""
+    response = request.registry.assets.response(
+        request, request.matchdict['name'])
+    if response is None:
+        return HTTPNotFound()
+    return response
+
+
+@view_config(route_name='cache_stats', renderer='json')
+def cache_stats(request):
+    """Return rendered page cache statistics as json."""
+    if not internal_request(request):
+        return HTTPForbidden()
+    stats = request.registry.page_cache.stats()
+    stats['feeds'] = request.registry.feeds.stats()
+    return stats
+
+
+@view_config(route_name='login_stats', renderer='json')
+def login_stats(request):
+    """Return password verifier and login throttling statistics as json."""
+    if not internal_request(request):
+        return HTTPForbidden()
+    registry = request.registry
+    return {
+        'verifier': registry.password_verifier.stats(),
+        'addr_limiter': registry.login_addr_limiter.stats(),
+        'user_limiter': registry.login_user_limiter.stats(),
+    }
+
+
+@view_config(route_name='timing_stats', renderer='json')
+def timing_stats(request):
+    """Return per-route request timing histograms as json."""
+    if not internal_request(request):
+        return HTTPForbidden()
+    return request.registry.timing_histograms.stats()
+
+
+@view_config(route_name='pool_stats', renderer='json')
+def pool_stats(request):
+    """Return database connection pool statistics as json."""
+    if not internal_request(request):
+        return HTTPForbidden()
+    return DBSession.bind.pool.stats()
+
+
+@view_config(route_name='replica_stats', renderer='json')
+def replica_stats(request):
+    """Return read replica lag and routing statistics as json."""
+    if not internal_request(request):
+        return HTTPForbidden()
+    return request.registry.replicas.stats()
+
+
+@view_config(route_name='job_stats', renderer='json')
+def job_stats(request):
+    """Return background job queue statistics as json."""
+    if not internal_request(request):
+        return HTTPForbidden()
+    return request.registry.jobs.stats()
+
+
+def make_replicas(settings):
+    """Return a ReplicaSet of the replicas in DATABASE_REPLICA_URLS.
+
+    Their engines share the primary's pool settings.
+    """
+    urls = os.environ.get('DATABASE_REPLICA_URLS', '')
+    engines = []
+    for url in filter(None, [url.strip() for url in urls.split(',')]):
+        engine = make_engine(dict(settings, **{'sqlalchemy.url': url}))
+        instrument_engine(engine)
+        engines.append(engine)
+    return ReplicaSet(
+        engines,
+        max_lag=float(os.environ.get('DB_REPLICA_MAX_LAG', 5)),
+        check_interval=float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 2)),
+    )
+
+
 def main():
-    """Create a configured wsgi app."""
+    """Create a configured wsgi app.
+
+    How long each phase of startup took, in milliseconds, is kept in the
+    journal.startup_ms setting.
+    """
+    timings = []
+    last = [time.time()]
+
+    def phase(name):
+        now = time.time()
+        timings.append((name, (now - last[0]) * 1000))
+        last[0] = now
+
     settings = {}
     settings['reload_all'] = os.environ.get('DEBUG', True)
     settings['debug_all'] = os.environ.get('DEBUG', True)
@@ -284,15 +1333,48 @@ def main():
     # )
     settings['sqlalchemy.url'] = os.environ.get(
         # must be rfc1738 URL
-        'DATABASE_URL', 'postgresql://mark:@localhost:5432/learning-journal'
+        'DATABASE_URL', DEFAULT_DATABASE_URL
     )
-    engine = sa.engine_from_config(settings, 'sqlalchemy.')
+    # size the connection pool to the number of server threads, so
+    # requests do not queue waiting for a connection
+    settings['waitress.threads'] = int(os.environ.get('WAITRESS_THREADS', 4))
+    settings['sqlalchemy.pool_size'] = int(os.environ.get(
+        'DB_POOL_SIZE', settings['waitress.threads']))
+    settings['sqlalchemy.max_overflow'] = int(os.environ.get(
+        'DB_MAX_OVERFLOW', 2))
+    settings['sqlalchemy.pool_timeout'] = int(os.environ.get(
+        'DB_POOL_TIMEOUT', 10))
+    settings['sqlalchemy.pool_recycle'] = int(os.environ.get(
+        'DB_POOL_RECYCLE', 3600))
+    settings['db.pool_pre_ping'] = asbool(os.environ.get(
+        'DB_POOL_PRE_PING', True))
+    engine = make_engine(settings)
+    instrument_engine(engine)
     DBSession.configure(bind=engine)
+    if os.environ.get('JOURNAL_AUTO_MIGRATE', ''):
+        from migrations import apply_migrations
+        apply_migrations(engine)
+    replicas = make_replicas(settings)
+    phase('engine')
+    # seconds shared caches may keep anonymous pages
+    settings['journal.cache_max_age'] = int(os.environ.get(
+        'JOURNAL_CACHE_MAX_AGE', 60))
     # Add authentication setting configuration
     settings['auth.username'] = os.environ.get('AUTH_USERNAME', 'admin')
-    manager = BCRYPTPasswordManager()
     settings['auth.password'] = os.environ.get(
-        'AUTH_PASSWORD', manager.encode('secret'))
+        'AUTH_PASSWORD', DEFAULT_PASSWORD_HASH)
+    # fraction of requests timed by the timing tween
+    settings['journal.timing_sample'] = float(os.environ.get(
+        'JOURNAL_TIMING_SAMPLE', 1))
+    settings['journal.timing_log_level'] = os.environ.get(
+        'JOURNAL_TIMING_LOG_LEVEL', 'INFO').upper()
+    settings['journal.trust_forwarded'] = asbool(os.environ.get(
+        'JOURNAL_TRUST_FORWARDED', False))
+    # compression of html, json and xml; see compression.py
+    settings['journal.compress'] = asbool(os.environ.get(
+        'JOURNAL_COMPRESS', True))
+    settings['journal.compress_min_size'] = int(os.environ.get(
+        'JOURNAL_COMPRESS_MIN_SIZE', 1024))
     # secret value for session signing:
     secret = os.environ.get('JOURNAL_SESSION_SECRET', 'itsaseekrit')
     session_factory = SignedCookieSessionFactory(secret)
@@ -311,19 +1393,86 @@ def main():
     )
     config.include('pyramid_jinja2')
     config.include('pyramid_tm')
+    # time template rendering for the timing tween
+    config.commit()
+    config.add_renderer('.jinja2', TimedRendererFactory(
+        config.registry.getUtility(IRendererFactory, name='.jinja2')))
+    # tweens added later wrap earlier ones, so compression is timed
+    config.add_tween('compression.compression_tween_factory')
+    config.add_tween('timing.timing_tween_factory')
+    config.registry.replicas = replicas
+    config.add_tween('replicas.replica_tween_factory')
+    phase('configurator')
     config.add_static_view('static', os.path.join(here, 'static'))
+    config.add_route('assets', '/assets/{name}')
+    config.registry.assets = Assets.load(
+        os.environ.get('JOURNAL_ASSETS_DIR', BUILD_DIR))
+    # pages link to the built assets, so a new build changes page ETags
+    config.registry.settings['journal.page_version'] = hashlib.sha1(
+        PAGE_VERSION + config.registry.assets.version).hexdigest()
+    phase('assets')
     config.add_route('home', '/')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
     config.add_route('detail', '/detail/{id:\d+}')
     config.add_route('edit', '/edit')
     config.add_route('new', '/new')
+    config.add_route('search', '/search')
+    config.add_route('feed', '/feed.atom')
+    config.add_route('sitemap', '/sitemap.xml')
+    config.add_route('api_entries', '/api/entries')
+    config.add_route('api_entry', '/api/entries/{id:\d+}')
+    config.add_route('api_revisions', '/api/entries/{id:\d+}/revisions')
+    config.add_route('api_revision',
+                     '/api/entries/{id:\d+}/revisions/{number:\d+}')
+    config.add_route('pool_stats', '/_internal/pool')
+    config.add_route('cache_stats', '/_internal/cache')
+    config.add_route('login_stats', '/_internal/login')
+    config.add_route('timing_stats', '/_internal/timing')
+    config.add_route('replica_stats', '/_internal/replicas')
+    config.add_route('job_stats', '/_internal/jobs')
+    # password checks run on a few threads; extra logins are refused
+    config.registry.password_verifier = PasswordVerifier(
+        workers=int(os.environ.get('LOGIN_WORKERS', 1)),
+        queue_size=int(os.environ.get('LOGIN_QUEUE_SIZE', 2)),
+    )
+    config.registry.login_addr_limiter = RateLimiter(
+        *parse_limit(os.environ.get('LOGIN_ADDR_LIMIT', '20/60')))
+    config.registry.login_user_limiter = RateLimiter(
+        *parse_limit(os.environ.get('LOGIN_USER_LIMIT', '10/60')))
+    config.registry.page_cache = PageCache(
+        size=int(os.environ.get('JOURNAL_PAGE_CACHE_SIZE', 1000)),
+        timeout=int(os.environ.get('JOURNAL_PAGE_CACHE_TTL', 300)),
+        last_modified=Entry.last_modified,
+        check_interval=float(
+            os.environ.get('JOURNAL_PAGE_CACHE_CHECK_INTERVAL', 2)),
+    )
+    # rendering and indexing after writes; see jobs.py
+    config.registry.jobs = JobQueue(
+        DBSession,
+        workers=int(os.environ.get('JOURNAL_JOB_WORKERS', 1)),
+        queue_size=int(os.environ.get('JOURNAL_JOB_QUEUE_SIZE', 10000)),
+        persist=asbool(os.environ.get('JOURNAL_PERSIST_JOBS', False)),
+    )
+    config.registry.feeds = Feeds(
+        Entry,
+        feed_size=int(os.environ.get('JOURNAL_FEED_SIZE', 20)),
+        check_interval=float(os.environ.get(
+            'JOURNAL_FEED_CHECK_INTERVAL', 10)),
+    )
+    phase('routes')
     config.scan()
+    phase('scan')
     app = config.make_wsgi_app()
+    phase('wsgi app')
+    app.registry.settings['journal.startup_ms'] = OrderedDict(timings)
+    log.info('configured in %.1f ms', sum(ms for _, ms in timings))
     return app
 
 
 if __name__ == '__main__':
+    from waitress import serve
     app = main()
     port = os.environ.get('PORT', 5000)
-    serve(app, host='0.0.0.0', port=port)
+    threads = app.registry.settings['waitress.threads']
+    serve(app, host='0.0.0.0', port=port, threads=threads)
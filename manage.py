@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Command line maintenance tasks for the learning journal.
+
+Usage: python manage.py <command> [options]
+"""
+import os
+import argparse
+import logging
+import sqlalchemy as sa
+import transaction
+import bulk
+from journal import (
+    DBSession,
+    DEFAULT_DATABASE_URL,
+    Entry,
+    RENDER_VERSION,
+    make_engine,
+)
+from renderer import render_markdown
+
+logging.basicConfig()
+log = logging.getLogger(__file__)
+
+
+def connect():
+    """Bind DBSession to the database named by DATABASE_URL."""
+    settings = {}
+    settings['sqlalchemy.url'] = os.environ.get(
+        'DATABASE_URL', DEFAULT_DATABASE_URL
+    )
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    return engine
+
+
+def backfill_html(batch_size=500):
+    """Store rendered html for every entry whose stored rendering is stale.
+
+    Entries are processed in id order and committed a batch at a time.
+    Like the update_entry job, html is only stored if the entry has not
+    been modified since it was read; an entry edited meanwhile keeps the
+    NULL html of its edit, for its own job or the next backfill.
+    Returns the number of entries rendered and stored.
+    """
+    stale = sa.or_(
+        Entry.html_version == None, Entry.html_version != RENDER_VERSION
+    )
+    total = 0
+    last_id = 0
+    while True:
+        with transaction.manager:
+            rows = DBSession.query(
+                Entry.id, Entry.text, Entry.modified).filter(
+                Entry.id > last_id).filter(stale).order_by(
+                Entry.id).limit(batch_size).all()
+            for row in rows:
+                total += DBSession.query(Entry).filter(
+                    Entry.id == row.id,
+                    Entry.modified == row.modified).update({
+                        'html': render_markdown(row.text),
+                        'html_version': RENDER_VERSION,
+                    }, synchronize_session=False)
+                last_id = row.id
+        if not rows:
+            return total
+        log.info('rendered %d entries', total)
+
+
+def cmd_backfill_html(args):
+    connect()
+    count = backfill_html(batch_size=args.batch_size)
+    print('rendered {} entries'.format(count))
+
+
+def cmd_migrate(args):
+    from migrations import apply_migrations, pending_migrations
+    engine = connect()
+    if args.list:
+        for name in pending_migrations(engine):
+            print(name)
+        return
+    for name in apply_migrations(engine):
+        print('applied {}'.format(name))
+
+
+def cmd_build_assets(args):
+    import assets
+    manifest = assets.build(build_dir=args.build_dir)
+    for name, built in sorted(manifest.items()):
+        print('{} -> {}'.format(name, built))
+
+
+def cmd_hash_password(args):
+    import getpass
+    from cryptacular.bcrypt import BCRYPTPasswordManager
+    password = getpass.getpass('Password: ')
+    if password != getpass.getpass('Again: '):
+        raise SystemExit('passwords do not match')
+    print(BCRYPTPasswordManager().encode(password))
+
+
+def cmd_import(args):
+    connect()
+    count = bulk.import_path(
+        args.path, format=args.format, batch_size=args.batch_size,
+        render=args.render, jobs=args.jobs)
+    print('imported {} entries'.format(count))
+
+
+def cmd_export(args):
+    connect()
+    bulk.export_path(args.path, format=args.format)
+
+
+def cmd_run_jobs(args):
+    from jobs import JobQueue
+    connect()
+    count = JobQueue(DBSession, persist=True).run_pending(
+        max_attempts=args.max_attempts)
+    print('ran {} jobs'.format(count))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+
+    backfill = commands.add_parser(
+        'backfill-html', help='render and store html for stale entries')
+    backfill.add_argument('--batch-size', type=int, default=500)
+    backfill.set_defaults(func=cmd_backfill_html)
+
+    migrate = commands.add_parser(
+        'migrate', help='apply pending schema migrations')
+    migrate.add_argument('--list', action='store_true',
+                         help='only list pending migrations')
+    migrate.set_defaults(func=cmd_migrate)
+
+    build_assets = commands.add_parser(
+        'build-assets', help='build fingerprinted, compressed static assets')
+    build_assets.add_argument('--build-dir', default=os.environ.get(
+        'JOURNAL_ASSETS_DIR', os.path.join('static', 'build')))
+    build_assets.set_defaults(func=cmd_build_assets)
+
+    import_ = commands.add_parser(
+        'import', help='load entries from jsonl, csv or a markdown directory')
+    import_.add_argument('path', help="file, directory, or - for stdin")
+    import_.add_argument('--format', choices=bulk.FORMATS,
+                         help='default: guessed from the path')
+    import_.add_argument('--batch-size', type=int, default=10000)
+    import_.add_argument('--render', action='store_true',
+                         help='render markdown now, in parallel')
+    import_.add_argument('--jobs', type=int, default=None,
+                         help='render processes (default: one per core)')
+    import_.set_defaults(func=cmd_import)
+
+    export = commands.add_parser(
+        'export', help='write entries as jsonl, csv or a markdown directory')
+    export.add_argument('path', help="file, directory, or - for stdout")
+    export.add_argument('--format', choices=bulk.FORMATS,
+                        help='default: guessed from the path, else jsonl')
+    export.set_defaults(func=cmd_export)
+
+    run_jobs = commands.add_parser(
+        'run-jobs', help='run background jobs left in the jobs table')
+    run_jobs.add_argument('--max-attempts', type=int, default=5,
+                          help='skip jobs that have failed this often')
+    run_jobs.set_defaults(func=cmd_run_jobs)
+
+    hash_password = commands.add_parser(
+        'hash-password', help='print a bcrypt hash to use as AUTH_PASSWORD')
+    hash_password.set_defaults(func=cmd_hash_password)
+
+    return parser
+
+
+def run(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Schema migrations for the journal database.
+
+MIGRATIONS is an ordered list of (name, statements).  Each migration runs
+once, in its own transaction, and is recorded in the schema_migrations
+table.  A Postgres advisory lock keeps several processes starting at once
+from applying the same migration twice.  Statements are written so that a
+database already changed by hand can still be migrated.
+
+Apply with `python manage.py migrate`, or at startup by setting
+JOURNAL_AUTO_MIGRATE.
+"""
+import logging
+
+log = logging.getLogger(__file__)
+
+# arbitrary key for pg_advisory_lock, shared by every journal process
+LOCK_KEY = 7242015
+
+CREATE_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    name VARCHAR (127) PRIMARY KEY,
+    applied TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+)
+"""
+
+MIGRATIONS = [
+    ('0001_create_entries', [
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            id serial PRIMARY KEY,
+            title VARCHAR (127) NOT NULL,
+            text TEXT NOT NULL,
+            created TIMESTAMP NOT NULL
+        )
+        """,
+    ]),
+    ('0002_entries_html', [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS html TEXT",
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS html_version VARCHAR (40)",
+    ]),
+    ('0003_entries_listing_index', [
+        """
+        CREATE INDEX IF NOT EXISTS ix_entries_listing
+        ON entries (created DESC, id DESC, title)
+        """,
+        "ANALYZE entries",
+    ]),
+    ('0004_entries_modified', [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS modified TIMESTAMP",
+        "UPDATE entries SET modified = created WHERE modified IS NULL",
+        """
+        ALTER TABLE entries
+        ALTER COLUMN modified SET DEFAULT (now() at time zone 'utc'),
+        ALTER COLUMN modified SET NOT NULL
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_entries_modified ON entries (modified)",
+    ]),
+    ('0005_entries_search', [
+        "ALTER TABLE entries ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        """
+        UPDATE entries SET search_vector =
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(text, '')), 'B')
+        WHERE search_vector IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_entries_search
+        ON entries USING gin (search_vector)
+        """,
+        "ANALYZE entries",
+    ]),
+    ('0006_jobs', [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id serial PRIMARY KEY,
+            name VARCHAR (127) NOT NULL,
+            args TEXT NOT NULL,
+            created TIMESTAMP NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        )
+        """,
+    ]),
+    ('0007_entry_revisions', [
+        """
+        CREATE TABLE IF NOT EXISTS entry_revisions (
+            entry_id INTEGER NOT NULL
+                REFERENCES entries (id) ON DELETE CASCADE,
+            number INTEGER NOT NULL,
+            created TIMESTAMP NOT NULL,
+            title VARCHAR (127) NOT NULL,
+            text TEXT,
+            data BYTEA,
+            base INTEGER,
+            chain_size INTEGER,
+            PRIMARY KEY (entry_id, number)
+        )
+        """,
+    ]),
+    ('0008_entries_version', [
+        """
+        ALTER TABLE entries
+        ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1
+        """,
+        # the version is the number of the latest revision
+        """
+        UPDATE entries SET version = latest.number
+        FROM (SELECT entry_id, max(number) AS number FROM entry_revisions
+              GROUP BY entry_id) latest
+        WHERE entries.id = latest.entry_id
+        """,
+    ]),
+    # search vectors were briefly stored by a job after the write, which
+    # could be lost; writes store them again, so bring every row up to date
+    ('0009_entries_search_current', [
+        """
+        UPDATE entries SET search_vector = current.vector
+        FROM (SELECT id,
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(text, '')), 'B')
+                AS vector
+              FROM entries) current
+        WHERE entries.id = current.id
+          AND entries.search_vector IS DISTINCT FROM current.vector
+        """,
+    ]),
+]
+
+
+def applied_migrations(connection):
+    """Return the set of migration names already applied."""
+    connection.execute(CREATE_MIGRATIONS_TABLE)
+    rows = connection.execute("SELECT name FROM schema_migrations")
+    return set(row[0] for row in rows)
+
+
+def apply_migrations(engine, migrations=MIGRATIONS):
+    """Apply any migrations not yet recorded; return their names."""
+    applied = []
+    connection = engine.connect()
+    try:
+        connection.execute("SELECT pg_advisory_lock(%s)", LOCK_KEY)
+        try:
+            done = applied_migrations(connection)
+            for name, statements in migrations:
+                if name in done:
+                    continue
+                log.info('applying migration %s', name)
+                with connection.begin():
+                    for statement in statements:
+                        connection.execute(statement)
+                    connection.execute(
+                        "INSERT INTO schema_migrations (name) VALUES (%s)",
+                        name
+                    )
+                applied.append(name)
+        finally:
+            connection.execute("SELECT pg_advisory_unlock(%s)", LOCK_KEY)
+    finally:
+        connection.close()
+    return applied
+
+
+def pending_migrations(engine, migrations=MIGRATIONS):
+    """Return the names of migrations that have not been applied."""
+    connection = engine.connect()
+    try:
+        done = applied_migrations(connection)
+    finally:
+        connection.close()
+    return [name for name, _ in migrations if name not in done]
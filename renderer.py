@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Markdown rendering for journal entries.
+
+Building a markdown.Markdown instance loads every extension, so each thread
+keeps one configured instance and resets it between documents.  Pygments
+lexers and formatters used by codehilite are cached as well.
+
+Most requests serve stored html, so codehilite and the Pygments lookups
+are only imported when the first document is rendered.
+"""
+import hashlib
+import threading
+import markdown
+import pygments
+from timing import measure
+
+# markdown extensions used to render entry text
+MARKDOWN_EXTENSIONS = ['codehilite(linenums=True)', 'fenced_code']
+# stored renderings made with a different configuration are stale
+RENDER_VERSION = unicode(hashlib.sha1(repr(
+    (markdown.version, pygments.__version__, MARKDOWN_EXTENSIONS)
+)).hexdigest())
+
+_local = threading.local()
+_lock = threading.Lock()
+_lexers = {}
+_formatters = {}
+
+
+def cached_lexer(alias, **options):
+    """Return a shared Pygments lexer for a language alias.
+
+    Raises pygments.util.ClassNotFound for unknown aliases, like
+    pygments.lexers.get_lexer_by_name.
+    """
+    key = (alias, tuple(sorted(options.items())))
+    lexer = _lexers.get(key)
+    if lexer is None:
+        from pygments.lexers import get_lexer_by_name
+        lexer = get_lexer_by_name(alias, **options)
+        with _lock:
+            lexer = _lexers.setdefault(key, lexer)
+    return lexer
+
+
+def cached_formatter(name, **options):
+    """Return a shared Pygments formatter for a name and options."""
+    key = (name, tuple(sorted(
+        (k, tuple(v) if isinstance(v, list) else v)
+        for k, v in options.items()
+    )))
+    formatter = _formatters.get(key)
+    if formatter is None:
+        from pygments.formatters import get_formatter_by_name
+        formatter = get_formatter_by_name(name, **options)
+        with _lock:
+            formatter = _formatters.setdefault(key, formatter)
+    return formatter
+
+
+def patch_codehilite():
+    """Make codehilite use the cached lexers and formatters."""
+    from markdown.extensions import codehilite
+    # codehilite (also used by fenced_code) looks these up at module level
+    codehilite.get_lexer_by_name = cached_lexer
+    codehilite.get_formatter_by_name = cached_formatter
+
+
+def get_markdown():
+    """Return this thread's configured Markdown instance."""
+    md = getattr(_local, 'md', None)
+    if md is None:
+        patch_codehilite()
+        md = _local.md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return md
+
+
+def render_markdown(text):
+    """Return entry text rendered to html."""
+    md = get_markdown()
+    try:
+        with measure('markdown'):
+            return md.convert(text)
+    finally:
+        md.reset()
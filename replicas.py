@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Routing of anonymous reads to read replicas.
+
+DBSession is bound to the primary.  For anonymous GET and HEAD requests a
+tween picks a replica from the registry's ReplicaSet, round robin, and
+RoutingSession sends that request's statements to it; flushes, and every
+other request, use the primary.
+
+Reads that must see a write stay on the primary:
+
+- logged in users, who are the only ones writing, always use it;
+- a logged in user's successful POST sets a short-lived cookie that keeps
+  their browser on the primary until the replicas have caught up;
+- for max_lag seconds after a write, this process reads from the primary,
+  so pages it caches after invalidating them are not stale.
+
+Replicas are checked every check_interval seconds, by whichever request
+finds a check due; one that fails the check or is more than max_lag
+seconds behind is left out until it recovers.  With no healthy replica,
+reads use the primary.
+
+Replica URLs come from DATABASE_REPLICA_URLS, comma separated.
+"""
+import time
+import logging
+import itertools
+import threading
+from sqlalchemy.orm import Session
+
+log = logging.getLogger(__file__)
+
+# set on a client after it writes; while present it reads from the primary
+STICKY_COOKIE = 'journal_primary'
+
+# seconds a standby's replay is behind, 0 when it has replayed everything
+# it received or is not a standby; {wal} and {lsn} depend on the version
+REPLICA_LAG = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_{wal}_receive_{lsn}() = pg_last_{wal}_replay_{lsn}() THEN 0
+    ELSE coalesce(
+        extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+_local = threading.local()
+
+
+def replica_lag(engine):
+    """Return how many seconds a Postgres standby is behind its primary."""
+    with engine.connect() as conn:
+        if engine.dialect.server_version_info >= (10,):
+            names = {'wal': 'wal', 'lsn': 'lsn'}
+        else:
+            names = {'wal': 'xlog', 'lsn': 'location'}
+        return float(conn.execute(REPLICA_LAG.format(**names)).scalar())
+
+
+def current_replica():
+    """Return the replica engine chosen for this thread's request, or None."""
+    return getattr(_local, 'replica', None)
+
+
+def use_replica(engine):
+    """Send this thread's reads to engine; None sends them to the primary."""
+    _local.replica = engine
+
+
+class RoutingSession(Session):
+    """A Session reading from the current replica, if one is chosen.
+
+    Flushes always go to the session's own bind, the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = current_replica()
+        if replica is not None and not self._flushing:
+            return replica
+        return Session.get_bind(self, mapper, clause)
+
+
+class ReplicaSet(object):
+    """Replica engines handed out round robin while they are healthy."""
+
+    def __init__(self, engines, max_lag=5, check_interval=2, lag=replica_lag,
+                 clock=time.time):
+        self.engines = list(engines)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lag = lag
+        self._clock = clock
+        self._healthy = list(self.engines)
+        self._lags = dict((engine, None) for engine in self.engines)
+        self._turn = itertools.count()
+        self._next_check = 0
+        self._last_write = None
+        self._check_lock = threading.Lock()
+        self.chosen = 0
+        self.primary_reads = 0
+
+    def __len__(self):
+        return len(self.engines)
+
+    def check(self):
+        """Measure each replica's lag and update which are in rotation."""
+        healthy = []
+        for engine in self.engines:
+            try:
+                lag = self._lag(engine)
+            except Exception as e:
+                log.warning('replica %r failed its check: %s', engine.url, e)
+                lag = None
+            self._lags[engine] = lag
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(engine)
+            elif engine in self._healthy:
+                log.warning('taking replica %r out of rotation, lag %s',
+                            engine.url, lag)
+        for engine in healthy:
+            if engine not in self._healthy:
+                log.info('returning replica %r to rotation', engine.url)
+        self._healthy = healthy
+        self._next_check = self._clock() + self.check_interval
+
+    def wrote(self):
+        """Note a write; reads use the primary for the next max_lag seconds."""
+        self._last_write = self._clock()
+
+    def choose(self):
+        """Return a healthy replica for a read, or None for the primary."""
+        now = self._clock()
+        if now >= self._next_check and self._check_lock.acquire(False):
+            try:
+                self.check()
+            finally:
+                self._check_lock.release()
+        healthy = self._healthy
+        if not healthy or (self._last_write is not None and
+                           now - self._last_write < self.max_lag):
+            self.primary_reads += 1
+            return None
+        self.chosen += 1
+        return healthy[next(self._turn) % len(healthy)]
+
+    def dispose(self):
+        """Close every replica's pooled connections, as after a fork."""
+        for engine in self.engines:
+            engine.dispose()
+
+    def stats(self):
+        """Return a dict of each replica's lag and rotation figures."""
+        return {
+            'replicas': [{
+                'url': repr(engine.url),
+                'healthy': engine in self._healthy,
+                'lag': self._lags[engine],
+            } for engine in self.engines],
+            'max_lag': self.max_lag,
+            'replica_reads': self.chosen,
+            'primary_reads': self.primary_reads,
+        }
+
+
+def replica_tween_factory(handler, registry):
+    """Tween choosing where each request reads from; see module docstring."""
+    replicas = getattr(registry, 'replicas', None)
+    if not replicas:
+        return handler
+    sticky = int(replicas.max_lag) + 1
+
+    def replica_tween(request):
+        if request.method not in ('GET', 'HEAD'):
+            response = handler(request)
+            # only logged in users can add or edit entries
+            if request.authenticated_userid and response.status_int < 400:
+                replicas.wrote()
+                response.set_cookie(STICKY_COOKIE, '1', max_age=sticky,
+                                    httponly=True)
+            return response
+        if (STICKY_COOKIE in request.cookies or
+                request.authenticated_userid):
+            return handler(request)
+        use_replica(replicas.choose())
+        try:
+            return handler(request)
+        finally:
+            use_replica(None)
+    return replica_tween
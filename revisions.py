@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Compact storage of entry revisions.
+
+Every version of an entry's text is kept in entry_revisions.  Writes
+store a revision's text as it is; the pack_revisions job then replaces it
+with either a snapshot, the whole text compressed, or a delta, the
+changes from the previous revision compressed, so storage grows with the
+size of each edit rather than the size of the entry.
+
+A revision is rebuilt from the nearest snapshot at or before it by
+applying the deltas after that snapshot in order.  A new snapshot is
+taken once SNAPSHOT_INTERVAL deltas, or deltas larger in total than a
+snapshot would be, have followed the last one, so rebuilding any revision
+reads a bounded number of rows and bytes.
+
+Deltas are json lists, compressed.  [start, end] copies the previous
+text's tokens start to end; a string is inserted as it is.  Tokens are
+words with the whitespace after them, so a small change to a long
+paragraph costs about as much as the words changed.
+"""
+import re
+import json
+import zlib
+from difflib import SequenceMatcher
+
+# at most this many deltas follow a snapshot
+SNAPSHOT_INTERVAL = 16
+COMPRESS_LEVEL = 6
+
+TOKEN = re.compile(r'\S+\s*|\s+', re.UNICODE)
+
+
+def tokens(text):
+    """Split text into tokens that join back into it."""
+    return TOKEN.findall(text)
+
+
+def pack_text(text):
+    """Return text compressed, as a snapshot."""
+    return zlib.compress(text.encode('utf-8'), COMPRESS_LEVEL)
+
+
+def unpack_text(data):
+    return zlib.decompress(data).decode('utf-8')
+
+
+def make_delta(old, new):
+    """Return a compressed delta that turns text old into text new.
+
+    Most edits touch one part of an entry, so the unchanged start and end
+    are matched directly and only the rest goes through difflib.
+    """
+    a, b = tokens(old), tokens(new)
+    start = 0
+    limit = min(len(a), len(b))
+    while start < limit and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < limit - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    ops = [[0, start]] if start else []
+    matcher = SequenceMatcher(None, a[start:len(a) - end],
+                              b[start:len(b) - end])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([start + i1, start + i2])
+        elif j2 > j1:
+            ops.append(u''.join(b[start + j1:start + j2]))
+    if end:
+        ops.append([len(a) - end, len(a)])
+    return zlib.compress(json.dumps(ops, separators=(',', ':')),
+                         COMPRESS_LEVEL)
+
+
+def apply_delta(old, delta):
+    """Return the text a delta made by make_delta(old, ...) describes."""
+    a = tokens(old)
+    parts = []
+    for op in json.loads(zlib.decompress(delta)):
+        if isinstance(op, list):
+            parts.extend(a[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return u''.join(parts)
+
+
+def needs_snapshot(chain_length, chain_size, delta, snapshot):
+    """Return True if a revision should be stored as a snapshot.
+
+    chain_length and chain_size are the count and bytes of the deltas
+    since the last snapshot, before this one; delta and snapshot are this
+    revision's two possible encodings.
+    """
+    return (chain_length >= SNAPSHOT_INTERVAL or
+            chain_size + len(delta) > len(snapshot))
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Pre-forking production server for the learning journal.
+
+The master process builds the app with journal.main() and binds the
+listening socket once, then forks worker processes that each run a
+threaded waitress server on that socket.  Markdown rendering and bcrypt
+checks are CPU bound, so separate processes keep one busy request from
+holding the GIL for every other request.
+
+Environment:
+    PORT                 port to listen on (default 5000)
+    WEB_CONCURRENCY      worker processes (default: number of cores)
+    WAITRESS_THREADS     threads per worker (default 4)
+    WAITRESS_BACKLOG     listen backlog (default 1024)
+    MAX_REQUESTS         recycle a worker after this many requests (0: never)
+    MAX_REQUESTS_JITTER  random extra requests, so workers recycle apart
+    GRACEFUL_TIMEOUT     seconds a stopping worker may finish requests
+
+Signals to the master:
+    TERM, INT   stop workers gracefully, then exit
+    HUP         start fresh workers, then gracefully stop the old ones
+"""
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import asyncore
+import logging
+import threading
+import multiprocessing
+from waitress.adjustments import Adjustments
+from waitress.server import TcpWSGIServer
+
+logging.basicConfig()
+log = logging.getLogger(__file__)
+
+# seconds a stopping worker leaves a quiet connection open, so a request
+# that is already on its way is still answered
+IDLE_GRACE = 1
+
+
+class PreboundWSGIServer(TcpWSGIServer):
+    """A waitress server on a socket that the master already bound."""
+
+    def bind_server_socket(self):
+        pass
+
+
+class RequestLimit(object):
+    """WSGI middleware calling on_limit once limit requests have started."""
+
+    def __init__(self, app, limit, on_limit):
+        self.app = app
+        self.limit = limit
+        self.on_limit = on_limit
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.count += 1
+            reached = self.count == self.limit
+        if reached:
+            self.on_limit()
+        return self.app(environ, start_response)
+
+
+class Worker(object):
+    """Serves the app on the shared socket until told to stop."""
+
+    def __init__(self, app, sock, adj, max_requests=0, graceful_timeout=30):
+        self.stopping = False
+        if max_requests:
+            app = RequestLimit(app, max_requests, self.stop)
+        self.server = PreboundWSGIServer(app, _sock=sock, adj=adj)
+        self.graceful_timeout = graceful_timeout
+
+    def stop(self, *args):
+        """Ask the worker to stop; safe from signal handlers and threads."""
+        self.stopping = True
+        self.server.pull_trigger()
+
+    def run(self):
+        server = self.server
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        deadline = None
+        while True:
+            asyncore.loop(
+                timeout=server.adj.asyncore_loop_timeout,
+                map=server._map,
+                use_poll=server.adj.asyncore_use_poll,
+                count=1,
+            )
+            if not self.stopping:
+                continue
+            now = time.time()
+            if deadline is None:
+                # stop accepting; the other workers share the socket
+                deadline = now + self.graceful_timeout
+                server.del_channel()
+                server.socket.close()
+            self.close_idle(now - IDLE_GRACE)
+            if not server.active_channels or now > deadline:
+                break
+        server.task_dispatcher.shutdown()
+
+    def close_idle(self, cutoff):
+        """Close connections with nothing in flight since cutoff."""
+        for channel in list(self.server.active_channels.values()):
+            if (not channel.requests and channel.request is None and
+                    not channel.any_outbuf_has_data() and
+                    channel.last_activity < cutoff):
+                channel.handle_close()
+
+
+class Master(object):
+    """Forks and supervises worker processes."""
+
+    def __init__(self, app, sock, adj, workers, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30, on_fork=None,
+                 on_exit=None):
+        self.app = app
+        self.sock = sock
+        self.adj = adj
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.on_fork = on_fork
+        self.on_exit = on_exit
+        self.pids = set()
+        self.stopping = False
+        self.restart = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+        # in the worker
+        status = 0
+        try:
+            random.seed()
+            if self.on_fork is not None:
+                self.on_fork()
+            max_requests = self.max_requests
+            if max_requests and self.max_requests_jitter:
+                max_requests += random.randint(0, self.max_requests_jitter)
+            Worker(self.app, self.sock, self.adj, max_requests,
+                   self.graceful_timeout).run()
+            if self.on_exit is not None:
+                self.on_exit()
+        except Exception:
+            log.exception('worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def kill(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def reap(self, block):
+        """Forget workers that exited; return how many did."""
+        reaped = 0
+        while self.pids:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    return reaped
+                if e.errno == errno.ECHILD:
+                    self.pids.clear()
+                    return reaped
+                raise
+            if not pid:
+                return reaped
+            self.pids.discard(pid)
+            reaped += 1
+            block = False
+        return reaped
+
+    def handle_stop(self, *args):
+        self.stopping = True
+
+    def handle_restart(self, *args):
+        self.restart = True
+
+    def stop_workers(self, pids):
+        """Gracefully stop pids, killing any still running after the timeout."""
+        self.kill(pids, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.pids & pids and time.time() < deadline:
+            self.reap(block=False)
+            time.sleep(0.1)
+        self.kill(self.pids & pids, signal.SIGKILL)
+        while self.pids & pids:
+            self.reap(block=True)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        for _ in range(self.workers):
+            self.spawn()
+        log.info('master %d started %d workers', os.getpid(), self.workers)
+        while not self.stopping:
+            if self.restart:
+                self.restart = False
+                old = set(self.pids)
+                for _ in range(self.workers):
+                    self.spawn()
+                self.stop_workers(old)
+                continue
+            self.reap(block=False)
+            # replace workers that exited or recycled themselves
+            for _ in range(self.workers - len(self.pids)):
+                self.spawn()
+            time.sleep(0.5)
+        self.stop_workers(set(self.pids))
+
+
+def listen(host, port, backlog):
+    """Return a bound, listening TCP socket."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def main():
+    from journal import DBSession, main as make_app
+    app = make_app()
+    settings = app.registry.settings
+    port = int(os.environ.get('PORT', 5000))
+    adj = Adjustments(
+        host='0.0.0.0',
+        port=port,
+        threads=settings['waitress.threads'],
+        backlog=int(os.environ.get('WAITRESS_BACKLOG', 1024)),
+    )
+    sock = listen(adj.host, adj.port, adj.backlog)
+
+    def on_fork():
+        # connections opened by the master must not be shared by workers
+        DBSession.remove()
+        DBSession.bind.dispose()
+        app.registry.replicas.dispose()
+
+    graceful_timeout = float(os.environ.get('GRACEFUL_TIMEOUT', 30))
+
+    def on_exit():
+        # let jobs queued by the last requests finish
+        app.registry.jobs.join(graceful_timeout)
+
+    on_fork()
+    master = Master(
+        app, sock, adj,
+        workers=int(os.environ.get(
+            'WEB_CONCURRENCY', multiprocessing.cpu_count())),
+        max_requests=int(os.environ.get('MAX_REQUESTS', 0)),
+        max_requests_jitter=int(os.environ.get('MAX_REQUESTS_JITTER', 0)),
+        graceful_timeout=graceful_timeout,
+        on_fork=on_fork,
+        on_exit=on_exit,
+    )
+    master.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
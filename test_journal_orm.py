@@ -6,24 +6,22 @@ import pytest
 # from psycopg2 import IntegrityError
 import datetime
 import os
+import threading
 from cryptacular.bcrypt import BCRYPTPasswordManager
 import psycopg2
 
 # from journal import Entry
 # from journal import add2_entry
+from sqlalchemy import create_engine
 from sqlalchemy.exc import DataError, IntegrityError
 
-DB_SCHEMA = """
-CREATE TABLE IF NOT EXISTS entries (
-    id serial PRIMARY KEY,
-    title VARCHAR (127) NOT NULL,
-    text TEXT NOT NULL,
-    created TIMESTAMP NOT NULL
-)
-"""
 INSERT_ENTRY = """
 INSERT INTO entries(title, text, created) VALUES (%s, %s, %s)
 """
+INSERT_ENTRY_HTML = """
+INSERT INTO entries(title, text, created, html, html_version)
+VALUES (%s, %s, %s, %s, %s)
+"""
 # READ_ENTRIES = """
 # SELECT * FROM entries
 # """
@@ -78,15 +76,34 @@ def test_login_fails(app):
     assert INPUT_BTN not in actual
 
 
+def wait_for_jobs(app):
+    """Wait for the jobs queued by an app's requests to finish."""
+    assert app.app.registry.jobs.join(timeout=10)
+
+
+def wait_until(condition, timeout=10):
+    """Wait for condition() to be true; fail if it is not within timeout."""
+    import time
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            pytest.fail('gave up waiting after {} seconds'.format(timeout))
+        time.sleep(0.001)
+
+
 def init_db(settings):
-    with closing(connect_db(settings)) as db:
-        db.cursor().execute(DB_SCHEMA)
-        db.commit()
+    from migrations import apply_migrations
+    engine = create_engine(settings['db'])
+    apply_migrations(engine)
+    engine.dispose()
 
 
 def clear_db(settings):
     with closing(connect_db(settings)) as db:
+        db.cursor().execute("DROP TABLE entry_revisions")
         db.cursor().execute("DROP TABLE entries")
+        db.cursor().execute("DROP TABLE schema_migrations")
+        db.cursor().execute("DROP TABLE jobs")
         db.commit()
 
 
@@ -211,6 +228,559 @@ def test_read_entries_multiple(req_context):
         assert entry.id
 
 
+def test_read_entries_paginated(req_context):
+    """Test that read_entries pages through entries with cursors."""
+    from journal import read_entries, PAGE_SIZE
+    start = datetime.datetime.utcnow()
+    for idx in range(PAGE_SIZE + 5):
+        created = start + datetime.timedelta(seconds=idx)
+        item = ('Title {}'.format(idx), 'Text', created)
+        run_query(req_context.db, INSERT_ENTRY, item, False)
+    first = read_entries(req_context)
+    assert len(first['entries']) == PAGE_SIZE
+    assert first['entries'][0].title == 'Title {}'.format(PAGE_SIZE + 4)
+    assert first['newer'] is None
+    assert first['older']
+
+    req_context.params = {'before': first['older']}
+    second = read_entries(req_context)
+    assert [e.title for e in second['entries']] == [
+        'Title {}'.format(idx) for idx in range(4, -1, -1)]
+    assert second['older'] is None
+    assert second['newer']
+
+    req_context.params = {'after': second['newer']}
+    back = read_entries(req_context)
+    assert [e.id for e in back['entries']] == [
+        e.id for e in first['entries']]
+
+
+def test_read_entries_bad_cursor(req_context):
+    from journal import read_entries
+    req_context.params = {'before': 'not-a-cursor'}
+    response = read_entries(req_context)
+    assert response.status_code == 400
+
+
+def test_apply_migrations_idempotent(db):
+    from migrations import MIGRATIONS, apply_migrations, pending_migrations
+    engine = create_engine(db['db'])
+    try:
+        assert pending_migrations(engine) == []
+        assert apply_migrations(engine) == []
+        with closing(connect_db(db)) as conn:
+            names = run_query(conn, "SELECT name FROM schema_migrations")
+            indexes = run_query(
+                conn, "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = 'entries'")
+        assert sorted(n[0] for n in names) == [m[0] for m in MIGRATIONS]
+        assert ('ix_entries_listing',) in indexes
+    finally:
+        engine.dispose()
+
+
+def explain(query):
+    """Return the EXPLAIN output for a SQLAlchemy query."""
+    from journal import DBSession
+    statement = query.statement.compile(dialect=DBSession.bind.dialect)
+    with closing(DBSession.bind.raw_connection()) as conn:
+        cursor = conn.cursor()
+        cursor.execute('EXPLAIN ' + str(statement), statement.params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+# statements slower than this fail the query budget tests
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+
+class QueryLog(object):
+    """Records the SQL an engine runs, with parameters and durations.
+
+    Only statements run by the thread that created it are recorded, not
+    those of background jobs.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.thread = threading.current_thread()
+
+    def before(self, conn, cursor, statement, parameters, context, many):
+        if threading.current_thread() is not self.thread:
+            return
+        conn.info.setdefault('query_log_started', []).append(
+            datetime.datetime.now())
+
+    def after(self, conn, cursor, statement, parameters, context, many):
+        if threading.current_thread() is not self.thread:
+            return
+        started = conn.info['query_log_started'].pop()
+        elapsed = datetime.datetime.now() - started
+        self.statements.append(
+            (statement, parameters, elapsed.total_seconds() * 1000))
+
+    def start(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self.before)
+        event.listen(self.engine, 'after_cursor_execute', self.after)
+
+    def stop(self):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self.before)
+        event.remove(self.engine, 'after_cursor_execute', self.after)
+
+    def clear(self):
+        self.statements = []
+
+    def explain(self, statement, parameters):
+        with closing(self.engine.raw_connection()) as conn:
+            cursor = conn.cursor()
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def report(self):
+        return '\n\n'.join('{:.1f} ms: {}  {!r}'.format(ms, statement, params)
+                           for statement, params, ms in self.statements)
+
+    def check(self, budget, slow_ms=SLOW_QUERY_MS):
+        """Fail if more than budget statements ran, or any was slow."""
+        if len(self.statements) > budget:
+            pytest.fail('{} queries, over a budget of {}:\n\n{}'.format(
+                len(self.statements), budget, self.report()))
+        for statement, params, ms in self.statements:
+            if ms > slow_ms:
+                pytest.fail('query took {:.1f} ms (limit {} ms):\n{}\n\n{}'
+                            .format(ms, slow_ms, statement,
+                                    self.explain(statement, params)))
+        self.clear()
+
+
+@pytest.mark.parametrize('count', [3, 30])
+def test_view_query_budgets(app, req_context, queries, count):
+    """Query counts must not grow with the number of entries."""
+    from journal import RENDER_VERSION
+    now = datetime.datetime.utcnow()
+    for i in range(count):
+        run_query(req_context.db, INSERT_ENTRY_HTML, (
+            'Title {}'.format(i), 'text', now + datetime.timedelta(seconds=i),
+            '<p>text</p>', RENDER_VERSION), False)
+    entry_id = run_query(req_context.db, "SELECT max(id) FROM entries")[0][0]
+    queries.clear()
+    app.get('/')
+    queries.check(budget=2)
+    app.get('/detail/{}'.format(entry_id))
+    queries.check(budget=2)
+
+    login_helper('admin', 'secret', app)
+    queries.clear()
+    app.get('/')
+    queries.check(budget=2)
+    app.get('/detail/{}'.format(entry_id))
+    queries.check(budget=2)
+    app.post('/new', params={'title': 'New', 'text': 'new text'})
+    queries.check(budget=1)
+    app.post('/edit', params={'id': entry_id, 'version': 1, 'title': 'T',
+                              'text': 'x'})
+    queries.check(budget=1)
+
+
+def test_query_log_reports_slow_queries(app, queries):
+    from journal import DBSession
+    import transaction
+    with transaction.manager:
+        DBSession.execute('SELECT pg_sleep(0.02)')
+    with pytest.raises(pytest.fail.Exception) as failure:
+        queries.check(budget=1, slow_ms=10)
+    assert 'pg_sleep' in str(failure.value)
+    assert 'Result' in str(failure.value)
+
+
+@pytest.mark.skipif(not os.environ.get('SLOW_TESTS'),
+                    reason='seeds a million rows; set SLOW_TESTS=1')
+def test_listing_queries_use_index(app, req_context):
+    from journal import DBSession, Entry, decode_cursor
+    run_query(req_context.db, """
+        INSERT INTO entries (title, text, created)
+        SELECT 'Title ' || g, 'Text ' || g,
+               timestamp '2015-01-01' + g * interval '1 second'
+        FROM generate_series(1, 1000000) g
+    """, get_results=False)
+    run_query(req_context.db, "ANALYZE entries", get_results=False)
+    cursor = decode_cursor('20150106000000000000.432000')
+    plans = [
+        explain(Entry.listing_query()),
+        explain(Entry.listing_query(before=cursor)),
+        explain(Entry.listing_query(after=cursor)),
+        # the query behind Entry.most_recent
+        explain(DBSession.query(Entry).order_by(Entry.created.desc()).limit(1)),
+    ]
+    for plan in plans:
+        assert 'ix_entries_listing' in plan, plan
+        assert 'Sort' not in plan, plan
+        assert 'Seq Scan' not in plan, plan
+
+
+def test_search(app, req_context, monkeypatch):
+    import jobs
+    # writes index entries themselves, so search works even if jobs are lost
+    monkeypatch.setitem(jobs.JOBS, 'update_entry', lambda id: None)
+    login_helper('admin', 'secret', app)
+    for title, text in [
+            ('Closures', 'A note on scope'),
+            ('Scope', 'Names bound in closures are looked up later'),
+            ('Unrelated', 'Check a < b & inspect it')]:
+        app.post('/new', params={'title': title, 'text': text}, status='2*')
+    app.get('/logout')
+
+    response = app.get('/search', params={'q': 'closure'})
+    # the title match ranks first, and snippets highlight the stemmed match
+    assert response.body.index('Closures') < response.body.index('Names')
+    assert '<mark>closures</mark>' in response.body
+    assert 'Unrelated' not in response.body
+    escaped = app.get('/search', params={'q': 'inspect'}).body
+    assert 'a &lt; b &amp; <mark>inspect</mark>' in escaped
+    assert 'No entries match' in app.get('/search', params={'q': 'xyzzy'})
+
+    entry_id = run_query(
+        req_context.db, "SELECT id FROM entries WHERE title = 'Unrelated'")[0][0]
+    login_helper('admin', 'secret', app)
+    app.post('/edit', params={
+        'id': entry_id, 'version': 1, 'title': 'Unrelated',
+        'text': 'more closures'})
+    assert 'Unrelated' in app.get('/search', params={'q': 'closures'})
+    app.get('/search', params={'q': 'x', 'page': '0'}, status=400)
+
+
+def test_search_pages(app, req_context):
+    import transaction
+    from journal import Entry
+    login_helper('admin', 'secret', app)
+    for i in range(5):
+        app.post('/new', params={'title': 'Page {}'.format(i), 'text': 'paged'})
+    wait_for_jobs(app)
+    with transaction.manager:
+        first, more = Entry.search(u'paged', page=1, limit=3)
+        second, more_after_second = Entry.search(u'paged', page=2, limit=3)
+    assert len(first) == 3 and more
+    assert len(second) == 2 and not more_after_second
+    assert not set(r.id for r in first) & set(r.id for r in second)
+    page = app.get('/search', params={'q': 'paged'})
+    assert 'Next' not in page.body
+
+
+@pytest.mark.skipif(not os.environ.get('SLOW_TESTS'),
+                    reason='seeds a million rows; set SLOW_TESTS=1')
+def test_search_uses_index(app, req_context):
+    import time
+    import sqlalchemy as sa
+    import transaction
+    from journal import DBSession, Entry
+    run_query(req_context.db, """
+        INSERT INTO entries (title, text, created, search_vector)
+        SELECT 'Title ' || g, 'Text about topic' || g,
+               timestamp '2015-01-01' + g * interval '1 second',
+               to_tsvector('english', 'Title ' || g || ' topic' || g)
+        FROM generate_series(1, 1000000) g
+    """, get_results=False)
+    run_query(req_context.db, "ANALYZE entries", get_results=False)
+    query = DBSession.query(Entry.id).filter(Entry.search_vector.op('@@')(
+        sa.func.plainto_tsquery('english', 'topic432000')))
+    assert 'ix_entries_search' in explain(query)
+    with transaction.manager:
+        Entry.search(u'topic432000')
+        start = time.time()
+        results, _ = Entry.search(u'topic432000')
+        elapsed = time.time() - start
+    assert elapsed < 0.02
+    assert len(results) == 1
+
+
+def test_api_entries(app, req_context):
+    start = datetime.datetime(2015, 3, 1)
+    for i in range(5):
+        run_query(req_context.db, INSERT_ENTRY, (
+            'Title {}'.format(i), '*text {}*'.format(i),
+            start + datetime.timedelta(days=i)), False)
+    first = app.get('/api/entries', params={'limit': 3}).json
+    assert [e['title'] for e in first['entries']] == [
+        'Title 4', 'Title 3', 'Title 2']
+    assert sorted(first['entries'][0]) == ['created', 'id', 'modified', 'title']
+    second = app.get('/api/entries', params={
+        'limit': 3, 'before': first['next'], 'fields': 'title,html'}).json
+    assert second['entries'] == [
+        {'title': 'Title 1', 'html': '<p><em>text 1</em></p>'},
+        {'title': 'Title 0', 'html': '<p><em>text 0</em></p>'},
+    ]
+    assert second['next'] is None
+    app.get('/api/entries', params={'fields': 'title,secret'}, status=400)
+    app.get('/api/entries', params={'before': 'junk'}, status=400)
+    for limit in ('0', '-1', 'many'):
+        app.get('/api/entries', params={'limit': limit}, status=400)
+
+    entry_id = first['entries'][0]['id']
+    entry = app.get('/api/entries/{}'.format(entry_id)).json
+    assert entry['text'] == '*text 4*'
+    assert entry['created'] == '2015-03-05T00:00:00'
+    assert app.get('/api/entries/{}?fields=id'.format(entry_id)).json == {
+        'id': entry_id}
+    app.get('/api/entries/{}'.format(entry_id + 100), status=404)
+
+
+def test_api_entries_stream(app, req_context, monkeypatch):
+    import json
+    import journal
+    monkeypatch.setattr(journal, 'STREAM_BATCH_SIZE', 2)
+    now = datetime.datetime.utcnow()
+    for i in range(5):
+        run_query(req_context.db, INSERT_ENTRY, (
+            'Title {}'.format(i), 'text', now), False)
+    response = app.get('/api/entries', params={
+        'format': 'jsonl', 'fields': 'title'})
+    assert response.content_type == 'application/x-ndjson'
+    lines = response.body.splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'title': 'Title {}'.format(i)} for i in range(5)]
+
+
+def test_compression(app, req_context, monkeypatch):
+    import gzip
+    import json
+    from io import BytesIO
+    from webob import Request
+    import compression
+    compressed = []
+    compress = compression.compress
+
+    def counting_compress(body, encoding):
+        compressed.append(encoding)
+        return compress(body, encoding)
+    monkeypatch.setattr(compression, 'compress', counting_compress)
+    now = datetime.datetime.utcnow()
+    for i in range(20):
+        run_query(req_context.db, INSERT_ENTRY, (
+            'Title {}'.format(i), 'text', now), False)
+
+    def get(url, **headers):
+        # webtest would transparently decode the body, so ask the app directly
+        return Request.blank(url, headers=headers).get_response(app.app)
+    plain = get('/')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.vary == ('Cookie', 'Accept-Encoding')
+    zipped = get('/', **{'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.content_length < len(plain.body)
+    assert gzip.GzipFile(fileobj=BytesIO(zipped.body)).read() == plain.body
+    assert zipped.headers['ETag'] == 'W/' + plain.headers['ETag']
+    # a cached page is compressed once per encoding
+    zipped = get('/', **{'Accept-Encoding': 'gzip, deflate, br'})
+    get('/', **{'Accept-Encoding': 'gzip, deflate, br'})
+    get('/', **{'Accept-Encoding': 'gzip'})
+    if compression.brotli is not None:
+        assert zipped.headers['Content-Encoding'] == 'br'
+        assert compression.brotli.decompress(zipped.body) == plain.body
+        assert compressed == ['gzip', 'br']
+    else:
+        # brotli is optional; without it gzip is sent
+        assert zipped.headers['Content-Encoding'] == 'gzip'
+        assert compressed == ['gzip']
+    assert get('/', **{'If-None-Match': zipped.headers['ETag']}
+               ).status_int == 304
+
+    # streamed responses are compressed as they are sent
+    streamed = get('/api/entries?format=jsonl', **{'Accept-Encoding': 'gzip'})
+    assert streamed.headers['Content-Encoding'] == 'gzip'
+    lines = gzip.GzipFile(fileobj=BytesIO(streamed.body)).read().splitlines()
+    assert len(lines) == 20 and json.loads(lines[0])['title'] == 'Title 0'
+    # small bodies and redirects are sent as they are
+    small = get('/api/entries?limit=1', **{'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+    assert 'Accept-Encoding' in small.vary
+    assert 'Content-Encoding' not in get(
+        '/logout', **{'Accept-Encoding': 'gzip'}).headers
+
+    monkeypatch.setenv('JOURNAL_COMPRESS', '0')
+    from journal import main
+    assert 'Content-Encoding' not in Request.blank('/', headers={
+        'Accept-Encoding': 'gzip'}).get_response(main()).headers
+
+
+def test_bulk_import_export(app, req_context, tmpdir):
+    import json
+    import bulk
+    source = tmpdir.join('in.jsonl')
+    source.write('\n'.join(json.dumps(entry) for entry in [
+        {'title': 'One', 'text': '*one*', 'created': '2015-03-01T10:00:00'},
+        {'title': u'Tw\xf6', 'text': 'two, "quoted"\nlines'},
+    ]))
+    assert bulk.import_path(str(source), batch_size=1) == 2
+    rows = run_query(req_context.db, """
+        SELECT title, text, created, html FROM entries ORDER BY id""")
+    assert rows[0][:3] == ('One', '*one*', datetime.datetime(2015, 3, 1, 10))
+    assert rows[0][3] is None
+    assert rows[1][1] == 'two, "quoted"\nlines'
+    assert 'One' in app.get('/search', params={'q': 'one'})
+
+    csv_path = str(tmpdir.join('out.csv'))
+    bulk.export_path(csv_path)
+    with open(csv_path) as f:
+        assert f.readline().strip() == 'id,title,text,created,modified'
+    markdown_dir = tmpdir.join('md')
+    bulk.export_path(str(markdown_dir))
+    assert len(markdown_dir.listdir()) == 2
+
+    run_query(req_context.db, "DELETE FROM entries", get_results=False)
+    assert bulk.import_path(csv_path) == 2
+    assert bulk.import_path(str(markdown_dir), render=True, jobs=2) == 2
+    rows = run_query(req_context.db, """
+        SELECT title, text, html FROM entries ORDER BY id""")
+    assert [row[0] for row in rows] == ['One', u'Tw\xf6'.encode('utf-8')] * 2
+    assert rows[2][1:] == ('*one*', '<p><em>one</em></p>')
+
+
+def test_server_timing(app, entry, req_context, monkeypatch):
+    import re
+    import logging
+    from journal import main
+    from webtest import TestApp
+
+    def timings(response):
+        return dict((part.split(';')[0], part) for part in
+                    response.headers['Server-Timing'].split(', '))
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logging.getLogger('timing').addHandler(handler)
+    try:
+        response = app.get('/')
+    finally:
+        logging.getLogger('timing').removeHandler(handler)
+    # each timed request is logged as one line
+    assert [record.getMessage().split(' total_ms')[0]
+            for record in records] == [
+        'timing method=GET route=home status=200']
+    assert records[0].levelno == logging.INFO
+    timing = timings(response)
+    assert sorted(timing) == ['compress', 'markdown', 'sql', 'template',
+                              'total']
+    assert float(timing['template'].split(';')[1].split('=')[1]) > 0
+    assert not timing['sql'].endswith('desc="0 calls"')
+    # the entry has no stored html, so its page renders it once
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    timing = timings(app.get('/detail/{}'.format(entry_id)))
+    assert re.match(r'markdown;dur=\d+\.\d;desc="1 calls"$',
+                    timing['markdown']), timing['markdown']
+    # writes leave rendering to a job, after the response
+    login_helper('admin', 'secret', app)
+    response = app.post('/new', params={'title': 'T', 'text': '*x*'})
+    assert timings(response)['markdown'].endswith('desc="0 calls"')
+    wait_for_jobs(app)
+
+    stats = app.get('/_internal/timing').json
+    assert stats['home']['total']['count'] == 1
+    assert stats['detail']['markdown']['count'] == 1
+
+    monkeypatch.setenv('JOURNAL_TIMING_SAMPLE', '0')
+    untimed = TestApp(main())
+    assert 'Server-Timing' not in untimed.get('/').headers
+
+
+def test_feed_and_sitemap(app, req_context, queries):
+    import gzip
+    import io
+    from xml.etree import ElementTree
+    from webob import Request
+    from journal import RENDER_VERSION
+    atom = '{http://www.w3.org/2005/Atom}'
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    for i in range(3):
+        when = long_ago + datetime.timedelta(hours=i)
+        run_query(req_context.db, "INSERT INTO entries (title, text, created, "
+                  "modified, html, html_version) VALUES (%s, %s, %s, %s, %s, "
+                  "%s)", ('Feed {}'.format(i), 'text', when, when,
+                          '<p>Stored {}</p>'.format(i), RENDER_VERSION), False)
+    response = app.get('/feed.atom')
+    assert response.content_type == 'application/atom+xml'
+    feed = ElementTree.fromstring(response.body)
+    assert [entry.findtext(atom + 'title') for entry in
+            feed.findall(atom + 'entry')] == ['Feed 2', 'Feed 1', 'Feed 0']
+    assert '&lt;p&gt;Stored 2&lt;/p&gt;' in response.body
+
+    # until entries change, serving the documents runs no queries
+    queries.clear()
+    app.get('/feed.atom', headers={'If-None-Match': response.headers['ETag']},
+            status=304)
+    # webtest would transparently decode the body, so ask the app directly
+    zipped = Request.blank('/feed.atom', headers={
+        'Accept-Encoding': 'gzip'}).get_response(app.app)
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.headers['ETag'] == 'W/' + response.headers['ETag']
+    assert gzip.GzipFile(fileobj=io.BytesIO(zipped.body)).read() == (
+        response.body)
+    app.get('/feed.atom', headers={'If-None-Match': zipped.headers['ETag']},
+            status=304)
+    sitemap = app.get('/sitemap.xml')
+    assert sitemap.content_type == 'application/xml'
+    assert sitemap.body.count('<url>') == 4
+    queries.check(budget=0)
+
+    login_helper('admin', 'secret', app)
+    app.post('/new', params={'title': 'Feed new', 'text': '*new*'})
+    app.get('/logout')
+    response = app.get('/feed.atom', headers={
+        'If-None-Match': response.headers['ETag']}, status=200)
+    feed = ElementTree.fromstring(response.body)
+    assert feed.find(atom + 'entry').findtext(atom + 'content') == (
+        '<p><em>new</em></p>')
+    # only the new entry, and the newest before it, which is within
+    # feeds.SLACK of the last look, were fetched again
+    assert app.app.registry.feeds.stats()['entries_fetched'] == 5
+
+
+def test_listing_streamed(app, req_context, monkeypatch):
+    import zlib
+    from webob import Request
+    import journal
+    monkeypatch.setattr(journal, 'PAGE_SIZE', 1)
+    monkeypatch.setattr(journal, 'STREAM_BATCH_SIZE', 2)
+    start = datetime.datetime(2015, 3, 1)
+    for i in range(25):
+        run_query(req_context.db, INSERT_ENTRY, (
+            'Title {}'.format(i), 'text', start + datetime.timedelta(days=i)),
+            False)
+    # it reads the whole table, so it is only for logged in users
+    assert 'class="all"' not in app.get('/')
+    app.get('/?all=1', status=403)
+    login_helper('admin', 'secret', app)
+    assert 'class="all"' in app.get('/')
+    cookie = '; '.join('{}={}'.format(*item) for item in app.cookies.items())
+    cached = app.app.registry.page_cache.stats()['listing_pages']
+    response = Request.blank('/?all=1', headers={
+        'Cookie': cookie}).get_response(app.app)
+    assert response.status_int == 200
+    assert response.content_type == 'text/html'
+    # the page goes out as rows are fetched, starting with the header
+    chunks = list(response.app_iter)
+    assert len(chunks) > 10
+    assert '<header>' in chunks[0] and 'Title 23 <' not in chunks[0]
+    body = ''.join(chunks)
+    assert body.index('Title 24 <') < body.index('Title 0 <')
+    # compressed, each chunk still decodes as it arrives
+    zipped = Request.blank('/?all=1', headers={
+        'Accept-Encoding': 'gzip', 'Cookie': cookie}).get_response(app.app)
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    decode = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    decoded = [decode(chunk) for chunk in zipped.app_iter]
+    assert len(decoded) > 10
+    assert '<header>' in decoded[0] and 'Title 23 <' not in decoded[0]
+    assert ''.join(decoded) == body
+    assert body.count('class="entry" id="entry=') == 25
+    assert 'class="pager"' not in body
+    assert app.app.registry.page_cache.stats()['listing_pages'] == cached
+    app.get('/?all=1', headers={'If-None-Match': response.headers['ETag']},
+            status=304)
+    assert response.headers['ETag'] != app.get('/').headers['ETag']
+
+
 def test_empty_listing(app):
     """Using webtest to test body of HTML and empty db."""
     response = app.get('/')
@@ -229,6 +799,116 @@ def test_listing(app, entry):
         assert expected in actual
 
 
+def test_listing_not_modified(app, entry):
+    first = app.get('/', status=200)
+    etag = first.headers['ETag']
+    assert 'public' in first.headers['Cache-Control']
+    assert first.headers['Vary'] == 'Cookie, Accept-Encoding'
+    response = app.get('/', headers={'If-None-Match': etag}, status=304)
+    assert response.body == ''
+    assert response.headers['ETag'] == etag
+    assert response.headers['Vary'] == 'Cookie, Accept-Encoding'
+    since = first.headers['Last-Modified']
+    app.get('/', headers={'If-Modified-Since': since}, status=304)
+
+    login_helper('admin', 'secret', app)
+    mine = app.get('/', headers={'If-None-Match': etag}, status=200)
+    assert mine.headers['ETag'] != etag
+    assert 'private' in mine.headers['Cache-Control']
+    app.post('/new', params={'title': 'Other', 'text': 'x'}, status='2*')
+    app.get('/logout')
+    changed = app.get('/', headers={'If-None-Match': etag}, status=200)
+    assert 'Other' in changed.body
+
+
+def test_detail_not_modified(app, req_context):
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY, ('T', 'before', now), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    url = '/detail/{}'.format(entry_id)
+    etag = app.get(url, status=200).headers['ETag']
+    app.get(url, headers={'If-None-Match': etag}, status=304)
+
+    login_helper('admin', 'secret', app)
+    app.post('/edit', params={'id': entry_id, 'version': 1, 'title': 'T',
+                              'text': 'after'})
+    app.get('/logout')
+    response = app.get(url, headers={'If-None-Match': etag}, status=200)
+    assert 'after' in response.body
+
+
+def test_page_cache_serves_anonymous_pages(app, req_context):
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY, ('Cached', 'text', now), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    url = '/detail/{}'.format(entry_id)
+    first_home = app.get('/')
+    first_detail = app.get(url)
+    # changes made behind the app's back are not seen until invalidation
+    run_query(req_context.db, "UPDATE entries SET title = 'Changed'",
+              get_results=False)
+    assert app.get('/').body == first_home.body
+    assert app.get(url).body == first_detail.body
+    etag = first_detail.headers['ETag']
+    app.get(url, headers={'If-None-Match': etag}, status=304)
+
+    login_helper('admin', 'secret', app)
+    assert 'Changed' in app.get(url).body
+    stats = app.get('/_internal/cache').json
+    assert stats['hits'] == 3
+    assert stats['misses'] == 2
+
+    app.post('/edit', params={'id': entry_id, 'version': 1, 'title': 'Edited',
+                              'text': 't'})
+    app.get('/logout')
+    assert 'Edited' in app.get('/').body
+    assert 'Edited' in app.get(url).body
+
+
+def test_page_cache_sees_other_processes_writes(app, req_context):
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY, ('Cached', 'text', now), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    url = '/detail/{}'.format(entry_id)
+    from cache import PageCache
+    from journal import Entry
+    clock = [1000.0]
+    app.app.registry.page_cache = PageCache(
+        last_modified=Entry.last_modified, check_interval=10,
+        clock=lambda: clock[0])
+    etag = app.get(url).headers['ETag']
+    assert 'Cached' in app.get('/')
+    # an edit committed by another worker changes modified, not this cache
+    run_query(req_context.db, """
+        UPDATE entries SET title = 'Changed',
+            modified = modified + interval '1 second'""", get_results=False)
+    clock[0] += 9
+    assert 'Cached' in app.get(url)
+    app.get(url, headers={'If-None-Match': etag}, status=304)
+    clock[0] += 1
+    assert 'Changed' in app.get(url)
+    assert 'Changed' in app.get('/')
+    app.get(url, headers={'If-None-Match': etag}, status=200)
+    assert app.app.registry.page_cache.stats()['checks'] == 1
+
+
+def test_page_cache_skips_stale_put():
+    from cache import PageCache
+    from pyramid.response import Response
+    cache = PageCache(size=10)
+    key = ('home', 'http://localhost', None, None)
+    generation = cache.generation()
+    cache.invalidate_listing()
+    cache.put(key, Response('stale'), generation)
+    assert cache.get(key) is None
+    cache.put(key, Response('fresh'), cache.generation())
+    assert cache.get(key).body == 'fresh'
+
+
+def test_detail_missing(app):
+    app.get('/detail/0', status=404)
+
+
 def test_post_to_add_view(auth_req, app):
     entry_data = {
         'title': 'Hello there',
@@ -248,6 +928,314 @@ def test_post_to_add_view(auth_req, app):
         assert expected in actual
 
 
+def test_post_returns_inserted_row(app, req_context):
+    login_helper('admin', 'secret', app)
+    response = app.post('/new', params={'title': 'Mine', 'text': 'x'},
+                        status='2*')
+    rows = run_query(req_context.db,
+                     "SELECT id, created FROM entries WHERE title='Mine'")
+    assert response.json == {
+        'id': rows[0][0],
+        'title': 'Mine',
+        'text': 'x',
+        'created': rows[0][1].strftime('%b %d, %Y'),
+    }
+
+
+def test_post_stores_rendered_html(app, req_context):
+    from journal import RENDER_VERSION
+    login_helper('admin', 'secret', app)
+    app.post('/new', params={'title': 'T', 'text': '*hi*'}, status='2*')
+    wait_for_jobs(app)
+    rows = run_query(req_context.db,
+                     "SELECT html, html_version FROM entries WHERE title='T'")
+    assert rows == [('<p><em>hi</em></p>', RENDER_VERSION)]
+
+
+def test_detail_uses_stored_html(app, req_context):
+    from journal import RENDER_VERSION
+    item = ('T', '*hi*', datetime.datetime.utcnow(), u'<p>stored</p>',
+            RENDER_VERSION)
+    run_query(req_context.db, INSERT_ENTRY_HTML, item, False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    response = app.get('/detail/{}'.format(entry_id))
+    assert '<p>stored</p>' in response.body
+    assert '*hi*' not in response.body
+
+
+def test_detail_renders_stale_html_without_storing(app, req_context,
+                                                   queries):
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY_HTML,
+              ('T', '*new*', now, '<p>stale</p>', 'old-version'), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    queries.clear()
+    response = app.get('/detail/{}'.format(entry_id))
+    assert '<p><em>new</em></p>' in response.body
+    # a read never writes; the stored html is left to the job or backfill
+    assert all(statement.lstrip().upper().startswith('SELECT')
+               for statement, _, _ in queries.statements)
+    assert run_query(req_context.db, "SELECT html FROM entries") == [
+        ('<p>stale</p>',)]
+
+
+def test_backfill_html(app, req_context):
+    from manage import backfill_html
+    from journal import RENDER_VERSION
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY, ('T', '*new*', now), False)
+    run_query(req_context.db, INSERT_ENTRY_HTML,
+              ('T', '*old*', now, '<p>stale</p>', 'old-version'), False)
+    assert backfill_html(batch_size=1) == 2
+    rows = run_query(req_context.db,
+                     "SELECT html, html_version FROM entries ORDER BY id")
+    assert rows == [('<p><em>new</em></p>', RENDER_VERSION),
+                    ('<p><em>old</em></p>', RENDER_VERSION)]
+    assert backfill_html() == 0
+
+
+def test_backfill_html_skips_edited_entries(app, req_context, monkeypatch):
+    import manage
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY, ('T', '*old*', now), False)
+    render_markdown = manage.render_markdown
+
+    def render_during_edit(text):
+        # an edit commits between the backfill's read and its write
+        run_query(req_context.db, """
+            UPDATE entries SET text = '*new*',
+                modified = modified + interval '1 second'""",
+                  get_results=False)
+        req_context.db.commit()
+        return render_markdown(text)
+    monkeypatch.setattr(manage, 'render_markdown', render_during_edit)
+    assert manage.backfill_html() == 0
+    assert run_query(req_context.db, "SELECT html FROM entries") == [
+        (None,)]
+    monkeypatch.setattr(manage, 'render_markdown', render_markdown)
+    assert manage.backfill_html() == 1
+    assert run_query(req_context.db, "SELECT html FROM entries") == [
+        ('<p><em>new</em></p>',)]
+
+
+def test_edit_renders_after_response(app, req_context, monkeypatch):
+    import jobs
+    now = datetime.datetime.utcnow()
+    run_query(req_context.db, INSERT_ENTRY, ('T', 'before', now), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    release = threading.Event()
+    update_entry = jobs.JOBS['update_entry']
+
+    def slow_update_entry(id):
+        release.wait(10)
+        update_entry(id)
+    monkeypatch.setitem(jobs.JOBS, 'update_entry', slow_update_entry)
+
+    login_helper('admin', 'secret', app)
+    response = app.post('/edit', params={
+        'id': entry_id, 'version': 1, 'title': 'T', 'text': '*after*'})
+    assert run_query(req_context.db, "SELECT html FROM entries") == [(None,)]
+    # the html is rendered on demand until the job stores it
+    html = app.get(response.json['html_url']).json['html']
+    assert html == '<p><em>after</em></p>'
+    release.set()
+    wait_for_jobs(app)
+    assert run_query(req_context.db, "SELECT html FROM entries") == [(html,)]
+    # update_entry and pack_revisions
+    assert app.get('/_internal/jobs').json['done'] == 2
+
+
+def test_revision_deltas():
+    import revisions
+    long_text = u''.join(u'Paragraph {} about d\xe9corators.\n\n'.format(i)
+                         for i in range(200))
+    edited = long_text.replace(u'Paragraph 100 ', u'Paragraph one hundred ')
+    for old, new in [(u'', u'text'), (u'text', u''), (u'a b\n', u'a c\n'),
+                     (long_text, edited), (edited, long_text + u'tail')]:
+        assert revisions.apply_delta(old, revisions.make_delta(old, new)) == new
+    delta = revisions.make_delta(long_text, edited)
+    assert len(delta) * 10 < len(revisions.pack_text(edited))
+    assert revisions.unpack_text(revisions.pack_text(edited)) == edited
+
+
+def test_entry_revisions(app, req_context, monkeypatch):
+    import revisions
+    monkeypatch.setattr(revisions, 'SNAPSHOT_INTERVAL', 2)
+    text = u''.join(u'Line {} of a long entry.\n'.format(i) for i in range(300))
+    run_query(req_context.db, INSERT_ENTRY, (
+        'Old', text, datetime.datetime.utcnow()), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    url = '/api/entries/{}/revisions'.format(entry_id)
+    app.get(url, status=403)
+    login_helper('admin', 'secret', app)
+    assert app.get(url).json == {'revisions': []}
+    texts = [text]
+    for i in range(5):
+        texts.append(texts[-1].replace(u'Line {} '.format(i * 50),
+                                       u'Edited line {} '.format(i)))
+        app.post('/edit', params={
+            'id': entry_id, 'version': i + 1, 'title': 'Title {}'.format(i),
+            'text': texts[-1].encode('utf-8')})
+    wait_for_jobs(app)
+    # the version from before revisions were kept was recorded first
+    history = app.get(url).json['revisions']
+    assert [(r['number'], r['title']) for r in history] == [
+        (1, 'Old')] + [(i + 2, 'Title {}'.format(i)) for i in range(5)]
+    for number, expected in enumerate(texts, 1):
+        revision = app.get('{}/{}'.format(url, number)).json
+        assert revision['text'] == expected
+    rows = run_query(req_context.db, """
+        SELECT number, base, text IS NULL, length(data) FROM entry_revisions
+        ORDER BY number""")
+    # snapshots at 1 and 4, each followed by at most two deltas
+    assert [row[1] for row in rows] == [1, 1, 1, 4, 4, 4]
+    assert all(row[2] for row in rows)
+    assert max(rows[1][3], rows[2][3], rows[4][3]) * 10 < rows[0][3]
+    app.get('{}/7'.format(url), status=404)
+
+    new_id = app.post('/new', params={'title': 'New', 'text': 'first'}).json['id']
+    wait_for_jobs(app)
+    assert app.get('/api/entries/{}/revisions/1'.format(new_id)).json[
+        'text'] == 'first'
+
+
+def test_edit_conflict(app, req_context):
+    run_query(req_context.db, INSERT_ENTRY, (
+        'T', 'first', datetime.datetime.utcnow()), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    login_helper('admin', 'secret', app)
+    assert 'name="version" id="version" value="1"' in app.get(
+        '/detail/{}'.format(entry_id))
+    edit = {'id': entry_id, 'title': 'T', 'text': 'second', 'version': 1}
+    assert app.post('/edit', params=edit).json['version'] == 2
+    # the same version again is an edit of an out of date copy
+    conflict = app.post('/edit', params=dict(edit, text='lost'), status=409)
+    assert conflict.json['version'] == 2
+    assert run_query(req_context.db, "SELECT text, version FROM entries") == [
+        ('second', 2)]
+    app.post('/edit', params=dict(edit, version=''), status=400)
+    app.post('/edit', params=dict(edit, id=entry_id + 1), status=404)
+    assert app.get('/api/entries/{}?fields=version'.format(entry_id)).json == {
+        'version': 2}
+    wait_for_jobs(app)
+
+
+def test_concurrent_edits(app, req_context):
+    """Many writers racing on one entry lose no edits and skip no versions."""
+    from webob import Request
+    run_query(req_context.db, INSERT_ENTRY, (
+        'T', 'start', datetime.datetime.utcnow()), False)
+    entry_id = run_query(req_context.db, "SELECT id FROM entries")[0][0]
+    login_helper('admin', 'secret', app)
+    cookie = '; '.join('{}={}'.format(*item) for item in app.cookies.items())
+    threads, edits = 8, 5
+    written = {}
+    conflicts = []
+    errors = []
+
+    def writer(n):
+        version = 1
+        done = 0
+        while done < edits:
+            text = u'writer {} edit {}'.format(n, done)
+            response = Request.blank('/edit', headers={'Cookie': cookie}, POST={
+                'id': str(entry_id), 'version': str(version), 'title': 'T',
+                'text': text}).get_response(app.app)
+            if response.status_int == 409:
+                conflicts.append(n)
+                version = response.json['version']
+            elif response.status_int == 200:
+                version = response.json['version']
+                written[version] = text
+                done += 1
+            else:
+                errors.append(response.status)
+                return
+
+    workers = [threading.Thread(target=writer, args=(n,))
+               for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wait_for_jobs(app)
+    assert errors == []
+    # every accepted edit got its own version, one after another
+    assert sorted(written) == range(2, threads * edits + 2)
+    last = threads * edits + 1
+    assert run_query(req_context.db, "SELECT text, version FROM entries") == [
+        (written[last], last)]
+    rows = run_query(req_context.db, """
+        SELECT number FROM entry_revisions WHERE data IS NOT NULL
+        ORDER BY number""")
+    assert [row[0] for row in rows] == range(1, last + 1)
+    for version in (2, last // 2, last):
+        assert app.get('/api/entries/{}/revisions/{}'.format(
+            entry_id, version)).json['text'] == written[version]
+
+
+def test_persisted_jobs(app, req_context, monkeypatch):
+    import transaction
+    import jobs
+    from journal import DBSession
+    calls = []
+
+    def flaky(value):
+        calls.append(value)
+        if len(calls) == 1:
+            raise ValueError('first try fails')
+    monkeypatch.setitem(jobs.JOBS, 'flaky', flaky)
+    queue = jobs.JobQueue(DBSession, workers=0, persist=True)
+    try:
+        with transaction.manager:
+            queue.defer('flaky', 1)
+        # it ran once committed, and failed, so it is kept
+        assert calls == [1]
+        assert run_query(req_context.db, "SELECT name, args, attempts, error "
+                         "FROM jobs") == [('flaky', '[1]', 1, 'first try fails')]
+        # jobs of aborted transactions are neither run nor kept
+        with pytest.raises(ZeroDivisionError):
+            with transaction.manager:
+                queue.defer('flaky', 2)
+                1 / 0
+        assert queue.run_pending() == 1
+        assert calls == [1, 1]
+        assert queue.stats()['failed'] == 1 and queue.stats()['done'] == 1
+        assert run_query(req_context.db, "SELECT count(*) FROM jobs") == [(0,)]
+    finally:
+        run_query(req_context.db, "DELETE FROM jobs", get_results=False)
+
+
+def test_render_markdown_matches_markdown():
+    import markdown
+    from renderer import MARKDOWN_EXTENSIONS, render_markdown
+    text = u'# Hi\n\n```python\nprint 1\n```\n\n[a][1]\n\n[1]: http://a.b\n'
+    expected = markdown.markdown(text, extensions=MARKDOWN_EXTENSIONS)
+    assert render_markdown(text) == expected
+    # state from the previous document must not leak into the next one
+    assert render_markdown(u'[a][1]') == u'<p>[a][1]</p>'
+
+
+def test_render_markdown_threads():
+    import threading
+    from renderer import render_markdown
+    texts = [u'```python\nx = {}\n```'.format(i) for i in range(8)]
+    expected = [render_markdown(text) for text in texts]
+    results = {}
+
+    def work(idx):
+        for _ in range(20):
+            results.setdefault(idx, set()).add(render_markdown(texts[idx]))
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for idx, html in enumerate(expected):
+        assert results[idx] == set([html])
+
+
 # def test_post_to_add_view_2(app):
 #     """Test if app.get('/add') is called returns error."""
 #     entry_data = {
@@ -284,6 +1272,284 @@ def test_do_login_missing_params(auth_req):
             do_login(auth_req)
 
 
+def test_rate_limiter():
+    from auth import RateLimiter
+    now = [0.0]
+    limiter = RateLimiter(2, 60, clock=lambda: now[0])
+    assert limiter.take('a') == 0
+    assert limiter.take('a') == 0
+    assert abs(limiter.take('a') - 30) < 1e-6
+    assert limiter.take('b') == 0
+    now[0] = 30
+    assert limiter.take('a') == 0
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_verifier_refuses_when_busy():
+    import threading
+    from auth import PasswordVerifier, VerifierBusy
+    release = threading.Event()
+
+    def check(hashed, password):
+        release.wait(10)
+        return hashed == password
+
+    verifier = PasswordVerifier(workers=1, queue_size=1, check=check)
+    results = []
+    waiting = [threading.Thread(target=lambda: results.append(
+        verifier.check('pw', 'pw'))) for _ in range(2)]
+    # one check is running and one is queued, so a third is refused
+    try:
+        waiting[0].start()
+        wait_until(lambda: verifier.stats()['in_progress'] >= 1)
+        waiting[1].start()
+        wait_until(lambda: verifier.stats()['queue_depth'] >= 1)
+        with pytest.raises(VerifierBusy):
+            verifier.check('pw', 'pw')
+    finally:
+        release.set()
+    for thread in waiting:
+        thread.join()
+    assert results == [True, True]
+    stats = verifier.stats()
+    assert stats['verified'] == 2
+    assert stats['rejected'] == 1
+
+
+def test_login_throttled(db, monkeypatch):
+    from journal import main
+    from webtest import TestApp
+    monkeypatch.setenv('DATABASE_URL', TEST_DSN)
+    monkeypatch.setenv('LOGIN_USER_LIMIT', '2/60')
+    app = TestApp(main())
+    for _ in range(2):
+        response = login_helper('admin', 'wrong', app)
+        assert response.status_code == 200
+    response = login_helper('admin', 'secret', app)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert 'Too many login attempts' in response.body
+    # other users are not affected
+    assert login_helper('other', 'secret', app).status_code == 200
+
+    stats = app.get('/_internal/login',
+                    extra_environ={'REMOTE_ADDR': '127.0.0.1'}).json
+    assert stats['user_limiter']['rejected'] == 1
+    assert stats['verifier']['verified'] == 2
+
+
+def test_make_engine_pool_settings():
+    from journal import make_engine, MeteredQueuePool
+    engine = make_engine({
+        'sqlalchemy.url': TEST_DSN,
+        'sqlalchemy.pool_size': 3,
+        'sqlalchemy.max_overflow': 1,
+    })
+    try:
+        assert isinstance(engine.pool, MeteredQueuePool)
+        conn = engine.connect()
+        stats = engine.pool.stats()
+        conn.close()
+        assert stats['size'] == 3
+        assert stats['max_overflow'] == 1
+        assert stats['checked_out'] == 1
+        assert stats['checkouts'] == 1
+    finally:
+        engine.dispose()
+
+
+def test_pool_stats_endpoint(app):
+    app.get('/_internal/pool', status=403)
+    login_helper('admin', 'secret', app)
+    response = app.get('/_internal/pool', status=200)
+    assert response.json['size'] == 4
+    assert 'wait_max_ms' in response.json
+
+
+def test_replica_set_rotation():
+    from replicas import ReplicaSet
+    first, second = create_engine('sqlite://'), create_engine('sqlite://')
+    lags = {first: 0, second: 0}
+
+    def lag(engine):
+        if lags[engine] is None:
+            raise IOError('connection refused')
+        return lags[engine]
+
+    now = [100.0]
+    replicas = ReplicaSet([first, second], max_lag=5, check_interval=2,
+                          lag=lag, clock=lambda: now[0])
+    assert [replicas.choose() for _ in range(4)] == [
+        first, second, first, second]
+
+    # stale and failing replicas leave the rotation at the next check
+    lags[first] = 30
+    assert replicas.choose() is first
+    now[0] += 2
+    assert set(replicas.choose() for _ in range(3)) == set([second])
+    lags[second] = None
+    now[0] += 2
+    assert replicas.choose() is None
+    stats = replicas.stats()
+    assert [r['healthy'] for r in stats['replicas']] == [False, False]
+    assert [r['lag'] for r in stats['replicas']] == [30, None]
+
+    lags[first] = lags[second] = 1
+    now[0] += 2
+    assert replicas.choose() is not None
+    # reads use the primary for max_lag seconds after a write
+    replicas.wrote()
+    assert replicas.choose() is None
+    now[0] += 5
+    assert replicas.choose() is not None
+
+
+def test_routing_session_reads_from_replica():
+    import sqlalchemy as sa
+    from sqlalchemy.ext.declarative import declarative_base
+    from replicas import RoutingSession, use_replica
+    Base = declarative_base()
+
+    class Note(Base):
+        __tablename__ = 'notes'
+        id = sa.Column(sa.Integer, primary_key=True)
+        text = sa.Column(sa.Text)
+
+    primary, replica = create_engine('sqlite://'), create_engine('sqlite://')
+    for engine, text in ((primary, 'on primary'), (replica, 'on replica')):
+        Base.metadata.create_all(engine)
+        engine.execute(Note.__table__.insert().values(text=text))
+    session = RoutingSession(bind=primary)
+    try:
+        use_replica(replica)
+        assert session.query(Note.text).scalar() == 'on replica'
+        assert session.execute(sa.select([Note.text])).scalar() == (
+            'on replica')
+        session.add(Note(text='written'))
+        session.commit()
+        assert replica.execute('SELECT count(*) FROM notes').scalar() == 1
+        assert primary.execute('SELECT count(*) FROM notes').scalar() == 2
+    finally:
+        use_replica(None)
+        session.close()
+    assert session.query(Note.text).first() == ('on primary',)
+    session.close()
+
+
+def test_replica_routing(db, monkeypatch):
+    from journal import main
+    from replicas import STICKY_COOKIE
+    from webtest import TestApp
+    monkeypatch.setenv('DATABASE_URL', TEST_DSN)
+    # the test database stands in for a replica that is never behind
+    monkeypatch.setenv('DATABASE_REPLICA_URLS', TEST_DSN)
+    wsgi_app = main()
+    replicas = wsgi_app.registry.replicas
+    app = TestApp(wsgi_app)
+    try:
+        app.get('/')
+        app.get('/detail/1', status=404)
+        assert replicas.stats()['replica_reads'] == 2
+        assert replicas.stats()['replicas'][0]['lag'] == 0
+
+        login_helper('admin', 'secret', app)
+        app.get('/')
+        response = app.post('/new', params={'title': 'Routed', 'text': 'x'})
+        assert STICKY_COOKIE in response.headers['Set-Cookie']
+        app.get('/logout')
+        app.get('/')
+        assert replicas.stats()['replica_reads'] == 2
+        assert replicas.stats()['primary_reads'] == 0
+
+        # without the cookie, this process still reads from the primary
+        app.reset()
+        assert 'Routed' in app.get('/').body
+        stats = replicas.stats()
+        assert (stats['replica_reads'], stats['primary_reads']) == (2, 1)
+    finally:
+        replicas.dispose()
+        clear_entries(db)
+
+
+def test_minify_css():
+    from assets import minify_css
+    css = "/* note */\na:hover ,\nb > i {\n  color: red;\n  margin: 0 1px;\n}\n"
+    assert minify_css(css) == 'a:hover,b>i{color:red;margin:0 1px}'
+
+
+def test_built_assets_served(db, tmpdir, monkeypatch):
+    import gzip
+    from io import BytesIO
+    import assets
+    from journal import main
+    from webob import Request
+    from webtest import TestApp
+    manifest = assets.build(build_dir=str(tmpdir))
+    monkeypatch.setenv('JOURNAL_ASSETS_DIR', str(tmpdir))
+    monkeypatch.setenv('DATABASE_URL', TEST_DSN)
+    app = TestApp(main())
+
+    css_url = '/assets/' + manifest['app.css']
+    page = app.get('/')
+    assert css_url in page.body
+    assert '/static/main.css' not in page.body
+
+    plain = app.get(css_url)
+    assert 'Content-Encoding' not in plain.headers
+    assert manifest['ys.jpg'] in plain.body
+    assert 'immutable' in plain.headers['Cache-Control']
+    # webtest would transparently decode the body, so ask the app directly
+    zipped = Request.blank(
+        css_url, headers={'Accept-Encoding': 'gzip'}).get_response(app.app)
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.GzipFile(fileobj=BytesIO(zipped.body)).read() == plain.body
+
+    app.get('/assets/' + manifest['ys.jpg'], status=200)
+    app.get('/assets/manifest.json', status=404)
+
+
+def test_startup_timings(monkeypatch):
+    from journal import main
+    monkeypatch.setenv('DATABASE_URL', TEST_DSN)
+    timings = main().registry.settings['journal.startup_ms']
+    assert list(timings)[0] == 'engine'
+    assert all(ms >= 0 for ms in timings.values())
+
+
+def test_prefork_server(db):
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+    import urllib2
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    env = dict(os.environ, DATABASE_URL=TEST_DSN, PORT=str(port),
+               WEB_CONCURRENCY='2', MAX_REQUESTS='2')
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, 'server.py'], cwd=here, env=env)
+    try:
+        url = 'http://127.0.0.1:{}/'.format(port)
+        for _ in range(50):
+            try:
+                urllib2.urlopen(url, timeout=5)
+                break
+            except IOError:
+                time.sleep(0.2)
+        # enough requests to recycle each worker at least once
+        for _ in range(6):
+            assert urllib2.urlopen(url, timeout=5).getcode() == 200
+        server.send_signal(signal.SIGHUP)
+        assert urllib2.urlopen(url, timeout=5).getcode() == 200
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait() == 0
+
+
 def test_logout(app):
     # re-use existing code to ensure we are logged in when we begin
     test_login_success(app)
@@ -304,6 +1570,16 @@ def app(db):
     return TestApp(app)
 
 
+@pytest.yield_fixture(scope='function')
+def queries(app):
+    """Log the SQL run by the app; see QueryLog.check."""
+    from journal import DBSession
+    log = QueryLog(DBSession.bind)
+    log.start()
+    yield log
+    log.stop()
+
+
 # Fixture for functional test of HTML with populated db."""
 @pytest.fixture(scope='function')
 def entry(db, request):
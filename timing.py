@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Per-request timing of SQL, markdown rendering, templates and compression.
+
+A tween starts a RequestTimings for a sample of requests; while it is
+active, SQLAlchemy cursor events, render_markdown, the jinja2 renderer and
+the compression tween add their durations to it.  When the response is
+ready its figures are sent in a Server-Timing header, logged as one
+key=value line and added to per-route histograms served from
+/_internal/timing.
+
+Outside a sampled request every hook is a thread-local lookup, so the
+instrumentation can stay on in production; JOURNAL_TIMING_SAMPLE sets the
+fraction of requests timed (default 1, 0 to turn it off).  The lines are
+logged at INFO by the timing logger, whose level JOURNAL_TIMING_LOG_LEVEL
+sets (default INFO; WARNING keeps only the header and histograms).
+"""
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+import sqlalchemy as sa
+
+log = logging.getLogger(__name__)
+
+# what is measured, in Server-Timing order; total is the whole request
+METRICS = ('sql', 'markdown', 'template', 'compress', 'total')
+# histogram bucket upper bounds, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    """Accumulated durations and counts for one request."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = dict((name, 0.0) for name in METRICS)
+        self.counts = dict((name, 0) for name in METRICS)
+
+    def add(self, name, seconds):
+        self.seconds[name] += seconds
+        self.counts[name] += 1
+
+    def finish(self):
+        self.add('total', time.time() - self.started)
+
+    def ms(self, name):
+        return self.seconds[name] * 1000
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header."""
+        return ', '.join(
+            '{};dur={:.1f};desc="{} calls"'.format(
+                name, self.ms(name), self.counts[name])
+            if name != 'total' else 'total;dur={:.1f}'.format(self.ms(name))
+            for name in METRICS)
+
+
+def current():
+    """Return the timings of the request being handled, or None."""
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def measure(name):
+    """Add the time spent in the with block to the current request."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(name, time.time() - start)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current() is not None:
+        conn.info.setdefault('timing_started', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    timings = current()
+    started = conn.info.get('timing_started')
+    if timings is not None and started:
+        timings.add('sql', time.time() - started.pop())
+
+
+def instrument_engine(engine):
+    """Time every statement engine runs during a timed request."""
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    sa.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+class TimedRendererFactory(object):
+    """Wraps a renderer factory so that rendering is timed as 'template'."""
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, info):
+        render = self.factory(info)
+
+        def timed_render(value, system):
+            with measure('template'):
+                return render(value, system)
+        return timed_render
+
+
+class Histograms(object):
+    """Bucketed durations of each metric for each route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, timings):
+        with self._lock:
+            metrics = self._routes.setdefault(route, dict(
+                (name, [0] * len(BUCKETS)) for name in METRICS))
+            for name in METRICS:
+                ms = timings.ms(name)
+                for i, bound in enumerate(BUCKETS):
+                    if ms <= bound:
+                        metrics[name][i] += 1
+                        break
+
+    def stats(self):
+        """Return {route: {metric: {count, p50, p95, p99, buckets}}}.
+
+        Percentiles are bucket upper bounds, in milliseconds.
+        """
+        with self._lock:
+            routes = dict((route, dict((name, list(counts))
+                                       for name, counts in metrics.items()))
+                          for route, metrics in self._routes.items())
+        result = {}
+        for route, metrics in routes.items():
+            result[route] = {}
+            for name, counts in metrics.items():
+                total = sum(counts)
+                summary = {
+                    'count': total,
+                    'buckets': dict((str(bound), count)
+                                    for bound, count in zip(BUCKETS, counts)),
+                }
+                for label, fraction in (('p50', .5), ('p95', .95),
+                                        ('p99', .99)):
+                    seen = 0
+                    for bound, count in zip(BUCKETS, counts):
+                        seen += count
+                        if seen >= fraction * total:
+                            summary[label] = bound
+                            break
+                result[route][name] = summary
+        return result
+
+
+def timing_tween_factory(handler, registry):
+    """Tween timing a sample of requests; see the module docstring."""
+    settings = registry.settings or {}
+    sample = float(settings.get('journal.timing_sample', 1))
+    # the app's root logger only passes warnings; the lines are wanted
+    log.setLevel(settings.get('journal.timing_log_level', 'INFO'))
+    histograms = registry.timing_histograms = Histograms()
+    if sample <= 0:
+        return handler
+
+    def timing_tween(request):
+        if sample < 1 and random.random() >= sample:
+            return handler(request)
+        timings = _local.timings = RequestTimings()
+        try:
+            response = handler(request)
+        finally:
+            _local.timings = None
+        timings.finish()
+        route = request.matched_route.name if request.matched_route else None
+        response.headers['Server-Timing'] = timings.server_timing()
+        histograms.record(route, timings)
+        log.info(
+            'timing method=%s route=%s status=%s total_ms=%.1f sql_count=%d '
+            'sql_ms=%.1f markdown_ms=%.1f template_ms=%.1f compress_ms=%.1f',
+            request.method, route, response.status_int, timings.ms('total'),
+            timings.counts['sql'], timings.ms('sql'), timings.ms('markdown'),
+            timings.ms('template'), timings.ms('compress'))
+        return response
+    return timing_tween